@@ -15,6 +15,7 @@ The scaCore script runs the core calculations for SCA, and stores the output usi
               b) Compute the dimension-reduced SCA correlation matrix :math:`\\tilde{C_{ij}}`, the projected alignment :math:`tX`, 
                  and the projector 
               c) Compute Ntrials of the randomized SCA matrix, and the eigenvectors and eigenvalues associated with each
+                 (or their analytic null model, see --null)
 
 :Arguments: 
      *.db (the database produced by running scaProcessMSA.py).
@@ -24,6 +25,27 @@ The scaCore script runs the core calculations for SCA, and stores the output usi
      -l              lambda parameter for pseudo-counting the alignment. Default: 0.03
      --Ntrials, -t   number of randomization trials
      --matlab, -m    write out the results of these calculations to a matlab workspace for further analysis
+     --jobs, -j      number of worker processes for the parallel calculations. Default: 1
+     --seed, -s      seed for the randomization trials (the results do not depend on --jobs). Default: 0
+     --adaptive, -a  adaptive number of randomization trials: stop as soon as more trials cannot change the number
+                     of significant eigenmodes (with at least --min-trials, and at most Ntrials trials)
+     --min-trials    minimum number of trials in the adaptive mode (below about 20 trials, the confidence interval
+                     of the threshold is too narrow, see scaTools.kposStats). Default: 20
+     --partial       compute only the 6 leading eigenvalues and eigenvectors of the randomized matrices (much faster
+                     for large alignments; Lrand then holds the 6 leading eigenvalues of each trial)
+     --seq-svd       algorithm for the singular value decompositions of the sequence projections: 'arpack', or
+                     'randomized' (see scaTools.svdss). Default: arpack
+     --ica-batch     minibatch size for the ICA rotations of the sequence projections, for very large alignments
+                     (see scaTools.rotICA). Default: full iterations
+     --precision     working precision of the large arrays: 'double', or 'single' (float32 storage, with float64
+                     accumulation of the sums that need it; about half the memory). Default: double
+     --null          null model for the spectrum of the SCA matrix: 'trials' (randomization trials, see scaTools.randomize)
+                     or 'analytic' (the mean and standard deviation of the second eigenvalue of the randomized
+                     matrices computed without random alignments, stored as Ntrials pseudo-trials, see
+                     scaTools.randomizeAnalytic; Frobenius norm only, --adaptive and --partial then have no
+                     effect). The threshold is within about 1.5% of that of the trials, but eigenvalues close to it
+                     can change kpos by one: on the alignments of Inputs/, kpos is 6 with 300 trials and 5 with
+                     the analytic null for DHFR_PEPM3, and 5 and 6 for s1Ahalabi_1470. Default: trials
 
 :Example: 
 >>> ./scaCore.py PF00071_full.db 
@@ -68,13 +90,35 @@ if __name__ == '__main__':
                         help="lambda parameter for pseudo-counting the alignment. Default: 0.03")
     parser.add_argument("-m", "--matlab", dest="matfile",  action="store_true", default=False,
                         help="write out the results of these calculations to a matlab workspace for further analysis")
+    parser.add_argument("-j", "--jobs", dest="jobs", default=1, type=int,
+                        help="number of worker processes for the parallel calculations. Default: 1")
+    parser.add_argument("-s", "--seed", dest="seed", default=0, type=int,
+                        help="seed for the randomization trials (the results do not depend on --jobs). Default: 0")
+    parser.add_argument("-a", "--adaptive", dest="adaptive", action="store_true", default=False,
+                        help="adaptive number of randomization trials: stop as soon as more trials cannot change the number of significant eigenmodes (with at least --min-trials, and at most Ntrials trials)")
+    parser.add_argument("--min-trials", dest="min_trials", default=20, type=int,
+                        help="minimum number of trials in the adaptive mode (below about 20 trials, the confidence interval of the threshold is too narrow, see scaTools.kposStats). Default: 20")
+    parser.add_argument("--partial", dest="partial", action="store_true", default=False,
+                        help="compute only the 6 leading eigenvalues and eigenvectors of the randomized matrices (much faster for large alignments; Lrand then holds the 6 leading eigenvalues of each trial)")
+    parser.add_argument("--seq-svd", dest="seq_svd", default='arpack', choices=['arpack', 'randomized'],
+                        help="algorithm for the singular value decompositions of the sequence projections: 'arpack', or 'randomized' (see scaTools.svdss). Default: arpack")
+    parser.add_argument("--ica-batch", dest="ica_batch", default=None, type=int,
+                        help="minibatch size for the ICA rotations of the sequence projections, for very large alignments (see scaTools.rotICA). Default: full iterations")
+    parser.add_argument("--precision", dest="precision", default='double', choices=['double', 'single'],
+                        help="working precision of the large arrays: 'double', or 'single' (float32 storage, with float64 accumulation of the sums that need it; about half the memory). Default: double")
+    parser.add_argument("--null", dest="null", default='trials', choices=['trials', 'analytic'],
+                        help="null model for the spectrum of the SCA matrix: 'trials' (randomization trials) or 'analytic' (the mean and standard deviation of the second eigenvalue of the randomized matrices computed without random alignments, stored as Ntrials pseudo-trials; Frobenius norm only, --adaptive and --partial then have no effect). The threshold is within about 1.5%% of that of the trials, but eigenvalues close to it can change kpos by one: on the alignments of Inputs/, kpos is 6 with 300 trials and 5 with the analytic null for DHFR_PEPM3, and 5 and 6 for s1Ahalabi_1470. Default: trials")
     options = parser.parse_args()
 
     if (options.norm != 'frob') & (options.norm != 'spec'):
         sys.exit("The option -n must be set to 'frob' or 'spec' - other keywords are not allowed.")
+    if (options.null == 'analytic') & (options.norm != 'frob'):
+        sys.exit("The analytic null model (--null analytic) is only available for the frobenius norm (-n frob).")
+    if (options.null == 'analytic') & (options.Ntrials < 2):
+        sys.exit("The analytic null model (--null analytic) needs at least 2 pseudo-trials (-t).")
 
     # extract the necessary stuff from the database...
-    with open(options.database, mode='rt') as db_file:
+    with open(options.database, mode='rb') as db_file:
         db_in = cPickle.load(db_file)
         D_in = db_in['sequence']
 
@@ -84,23 +128,42 @@ if __name__ == '__main__':
     Npos = D_in['Npos']
     ats = D_in['ats']
     hd = D_in['hd']
+    dtype = sca.precisionTypes[options.precision]
 
     # sequence analysis
     print_("Computing the sequence projections.")
-    Useq, Uica = sca.seqProj(msa_num, seqw, kseq=30, kica=15)
-    simMat = sca.seqSim(msa_num)
+    Useq, Uica = sca.seqProj(msa_num, seqw, kseq=30, kica=15, workers=options.jobs, batch=options.ica_batch,
+                             svd=options.seq_svd, dtype=dtype)
+    simMat = sca.seqSim(msa_num, workers=options.jobs)
 
     # SCA calculations
     print_("Computing the SCA conservation and correlation values.")
     Wia, Dia, Di = sca.posWeights(msa_num, seqw, options.lbda)
-    Csca, tX, Proj = sca.scaMat(msa_num, seqw, options.norm, options.lbda)
+    Csca, tX, Proj = sca.scaMat(msa_num, seqw, options.norm, options.lbda, workers=options.jobs, dtype=dtype)
 
     # Matrix randomizations
     print_("Computing matrix randomizations...")
     start = time.time()
-    Vrand, Lrand, Crand = sca.randomize(msa_num, options.Ntrials, seqw, options.lbda)
+    if options.null == 'analytic':
+        Vrand, Lrand, Crand, null_stats = sca.randomizeAnalytic(msa_num, options.Ntrials, seqw, lbda=options.lbda)
+    elif options.adaptive:
+        Lsca = sca.eigenVect(Csca)[1]
+        Vrand, Lrand, Crand, rand_stats = sca.randomize(msa_num, options.Ntrials, seqw, norm=options.norm,
+                                                        lbda=options.lbda, workers=options.jobs, seed=options.seed,
+                                                        Lsca=Lsca, min_trials=options.min_trials,
+                                                        partial=options.partial, dtype=dtype)
+    else:
+        Vrand, Lrand, Crand = sca.randomize(msa_num, options.Ntrials, seqw, norm=options.norm, lbda=options.lbda,
+                                            workers=options.jobs, seed=options.seed, partial=options.partial,
+                                            dtype=dtype)
     end = time.time()
-    print_("Randomizations complete, {:d} trials, time: {:.1f} minutes".format(options.Ntrials, (end - start) / 60))
+    Ntrials = Lrand.shape[0]
+    if options.null == 'analytic':
+        print_("Analytic null model complete, threshold {:.3f}, time: {:.1f} minutes".format(null_stats['threshold'],
+                                                                                         (end - start) / 60))
+    else:
+        print_("Randomizations complete ({} null), {:d} trials, time: {:.1f} minutes".format(options.null, Ntrials,
+                                                                                          (end - start) / 60))
 
     # saving...
     path_list = options.database.split(os.sep)
@@ -112,14 +175,21 @@ if __name__ == '__main__':
     D['Uica'] = Uica
     D['simMat'] = simMat
     D['lbda'] = options.lbda
+    D['precision'] = options.precision
     D['Dia'] = Dia
     D['Di'] = Di
     D['Csca'] = Csca
     D['tX'] = tX
     D['Proj'] = Proj
-    D['Ntrials'] = options.Ntrials
+    D['Ntrials'] = Ntrials
+    D['null'] = options.null
+    if options.adaptive and options.null == 'trials':
+        D['rand_stats'] = rand_stats
+    D['seed'] = options.seed
     D['Vrand'] = Vrand
     D['Lrand'] = Lrand
+    if options.null == 'analytic':
+        D['null_stats'] = null_stats
     D['Crand'] = Crand
 
     db = {}
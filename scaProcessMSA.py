@@ -36,6 +36,9 @@ The scaProcessMSA script conducts the basic steps in multiple sequence alignment
      --selectSeqs, -n  subsample the alignment to (1.5 * the number of effective sequences) to reduce computational time, default: False
      --truncate, -t    truncate the alignment to the positions in the reference PDB, default: False
      --matlab, -m      write out the results of this script to a matlab workspace for further analysis 
+     --jobs, -j        number of worker processes for the sequence similarity calculations, default: 1
+     --weights, -w     method for the sequence weights: 'exact', or 'lsh' for an approximation that is tractable for
+                       very large alignments (see seqWeightsLSH), default: exact
      --output          specify a name for the outputfile 
 
 :Example: 
@@ -87,6 +90,10 @@ if __name__ == '__main__':
                         help="truncate the alignment to the positions in the reference PDB, default: False")
     parser.add_argument("-m", "--matlab", action="store_true", dest="matfile", default=False,
                         help="write out the results of this script to a matlab workspace for further analysis")
+    parser.add_argument("-j", "--jobs", dest="jobs", default=1, type=int,
+                        help="number of worker processes for the sequence similarity calculations, default: 1")
+    parser.add_argument("-w", "--weights", dest="weights", default='exact', choices=['exact', 'lsh'],
+                        help="method for the sequence weights: 'exact', or 'lsh' for an approximation that is tractable for very large alignments (see seqWeightsLSH), default: exact")
     parser.add_argument("--output", dest="outputfile", default=None, help="specify an outputfile name")
     options = parser.parse_args()
 
@@ -110,32 +117,24 @@ if __name__ == '__main__':
         i_ref = options.i_ref
 
     # Read in initial alignment
-    headers_full, sequences_full = sca.readAlg(options.alignment)
-    print_('Loaded alignment of {:d} sequences, {:d} positions.'.format(len(headers_full), len(sequences_full[0])))
+    # (the alignment is kept in numeric representation throughout, with 0 for gaps)
+    headers_full, msa_bytes = sca.readAlgBytes(options.alignment)
+    print_('Loaded alignment of {:d} sequences, {:d} positions.'.format(*msa_bytes.shape))
 
     # Check the alignment and remove sequences containing non-standard amino acids
     print_("Checking alignment for non-standard amino acids")
-    alg_out = list()
-    hd_out = list()
-    for i, k in enumerate(sequences_full):
-        flag = 0
-        for aa in k:
-            if aa not in 'ACDEFGHIKLMNPQRSTVWY-':
-                flag = 1
-        if (flag == 0):
-            alg_out.append(k)
-            hd_out.append(headers_full[i])
-    headers_full = hd_out
-    sequences_full = alg_out
-    print_("Aligment size after removing sequences with non-standard amino acids: {:d}".format(len(sequences_full)))
+    seqok = np.flatnonzero((sca.bytes2num(msa_bytes, 'ACDEFGHIKLMNPQRSTVWY-') > 0).all(axis=1))
+    headers_full = [headers_full[s] for s in seqok]
+    msa_full = sca.bytes2num(msa_bytes[seqok])
+    print_("Aligment size after removing sequences with non-standard amino acids: {:d}".format(len(msa_full)))
 
     # Do an initial trimming to remove excessively gapped positions - this is
     # critical for building a correct ATS
     print_("Trimming alignment for highly gapped positions (80% or more).")
-    alg_out, poskeep = sca.filterPos(sequences_full, [1], 0.8)
-    sequences_ori = sequences_full
-    sequences_full = alg_out
-    print_("Alignment size post-trimming: {:d} positions".format(len(sequences_full[0])))
+    alg_out, poskeep = sca.filterPos(msa_full, [1], 0.8)
+    msa_ori = msa_full
+    msa_full = alg_out
+    print_("Alignment size post-trimming: {:d} positions".format(msa_full.shape[1]))
 
     # If i_ref is directly provided, we use it, ignoring all else.  Otherwise,
     # we explore the other ways of specifying a reference sequences: (1)
@@ -150,6 +149,7 @@ if __name__ == '__main__':
         if options.pdbid is not None:
             try:
                 seq_pdb, ats_pdb, dist_pdb = sca.pdbSeq(options.pdbid, options.chainID)
+                sequences_full = sca.num2lett(msa_full)
                 if options.species is not None:
                     try:
                         print_("Finding reference sequence using species-based best match..")
@@ -179,7 +179,7 @@ if __name__ == '__main__':
                         print_(sequences_full[i_ref])
                     except:
                         sys.exit("Error!!  Can't find reference sequence...")
-                sequences, ats = sca.makeATS(sequences_full, ats_pdb, seq_pdb, i_ref, options.truncate)
+                msa, ats = sca.makeATS(msa_full, ats_pdb, seq_pdb, i_ref, options.truncate)
                 dist_new = np.zeros((len(ats), len(ats)))
                 for (j, pos1) in enumerate(ats):
                     for (k, pos2) in enumerate(ats):
@@ -197,7 +197,7 @@ if __name__ == '__main__':
             print_("Finding reference sequence using provided sequence file...")
             try:
                 h_tmp, s_tmp = sca.readAlg(options.refseq)
-                i_ref = sca.MSAsearch(headers_full, sequences_full, s_tmp[0])
+                i_ref = sca.MSAsearch(headers_full, sca.num2lett(msa_full), s_tmp[0])
                 options.i_ref = i_ref
                 print_("reference sequence index is: {:d}".format(i_ref))
                 print_(headers_full[i_ref])
@@ -208,24 +208,23 @@ if __name__ == '__main__':
                         f.close()
                     except:
                         print_("Error reading reference position file! Using default numbering 1 to number of positions")
-                        ats_tmp = range(len(sequences[0]))
+                        ats_tmp = range(msa_full.shape[1])
                 else:
                     print_("No reference position list provided.  Using default numbering 1 to number of positions")
-                    ats_tmp = range(len(sequences[0]))
-                sequences, ats = sca.makeATS(
-                    sequences_full, ats_tmp, s_tmp[0], i_ref, options.truncate)
+                    ats_tmp = range(msa_full.shape[1])
+                msa, ats = sca.makeATS(
+                    msa_full, ats_tmp, s_tmp[0], i_ref, options.truncate)
             except:
                 sys.exit("Error!!  Can't find reference sequence...")
         else:
-            msa_num = sca.lett2num(sequences_full)
-            i_ref = sca.chooseRefSeq(sequences_full)
+            i_ref = sca.chooseRefSeq(msa_full, workers=options.jobs)
             print_("No reference sequence given, chose as default ({:d}): {}".format(i_ref, headers_full[i_ref]))
-            sequences = sequences_full
-            ats = range(len(sequences[0]))
+            msa = msa_full
+            ats = range(msa.shape[1])
     else:
         print_("using provided reference index {:d}".format(i_ref))
         print_(headers_full[i_ref])
-        s_tmp = sequences_ori[i_ref]
+        s_tmp = sca.num2lett(msa_ori[[i_ref]])[0]
         try:
             if options.refpos is not None:
                 f = open(options.refpos, 'r')
@@ -233,25 +232,26 @@ if __name__ == '__main__':
                 # print ats_tmp
                 f.close()
             else:
-                ats_tmp = range(len(sequences_full[0]))
-            sequences, ats = sca.makeATS(sequences_full, ats_tmp, s_tmp, i_ref, options.truncate)
+                ats_tmp = range(msa_full.shape[1])
+            msa, ats = sca.makeATS(msa_full, ats_tmp, s_tmp, i_ref, options.truncate)
         except:
             sys.exit("Error!!  Can't find reference sequence...")
 
     # filtering sequences and positions, calculations of effective number of seqs
-    print_("Conducting sequence and position filtering: alignment size is {:d} seqs, {:d} pos".format(len(sequences),
-                                                                                                      len(sequences[0])))
+    print_("Conducting sequence and position filtering: alignment size is {:d} seqs, {:d} pos".format(*msa.shape))
     if options.pdbid is not None:
         print_("ATS and distmat size - ATS: {:d}, distmat: {:d} x {:d}".format(len(ats), len(dist_pdb), len(dist_pdb[0])))
     else:
-        print_("ATS should also have {:d} positions - ATS: {:d}".format(len(sequences[0]), len(ats)))
+        print_("ATS should also have {:d} positions - ATS: {:d}".format(msa.shape[1], len(ats)))
 
     if i_ref is not None:
-        alg0, seqw0, seqkeep = sca.filterSeq(sequences, i_ref, max_fracgaps=options.parameters[1],
-                                             min_seqid=options.parameters[2], max_seqid=options.parameters[3])
+        alg0, seqw0, seqkeep = sca.filterSeq(msa, i_ref, max_fracgaps=options.parameters[1],
+                                             min_seqid=options.parameters[2], max_seqid=options.parameters[3],
+                                             workers=options.jobs, method=options.weights)
     else:
-        alg0, seqw0, seqkeep = sca.filterSeq(sequences, max_fracgaps=options.parameters[1], min_seqid=options.parameters[2],
-                                             max_seqid=options.parameters[3])
+        alg0, seqw0, seqkeep = sca.filterSeq(msa, max_fracgaps=options.parameters[1], min_seqid=options.parameters[2],
+                                             max_seqid=options.parameters[3], workers=options.jobs,
+                                             method=options.weights)
 
     headers = [headers_full[s] for s in seqkeep]
     alg1, iposkeep = sca.filterPos(alg0, seqw0, options.parameters[0])
@@ -261,24 +261,26 @@ if __name__ == '__main__':
     effseqsprelimit = int(seqw0.sum())
     Nseqprelimit = len(alg1)
     print_("After filtering: alignment size is {:d} seqs, {:d} effective seqs, {:d} pos".format(len(alg1), effseqsprelimit,
-                                                                                                len(alg1[0])))
+                                                                                                alg1.shape[1]))
 
     # Limitation of total sequences to [1.5 * # ofeffective sequences] if Nselect is set to True
     if (options.Nselect):
         seqsel = sca.randSel(seqw0, int(1.5 * effseqsprelimit), [seqkeep.index(i_ref)])
-        alg = [alg1[s] for s in seqsel]
+        msa_num = alg1[seqsel]
         hd = [headers[s] for s in seqsel]
     else:
-        alg = alg1
+        msa_num = alg1
         hd = headers
 
-    # calculation of final MSA, sequence weights
-    seqw = sca.seqWeights(alg)
+    # calculation of final MSA, sequence weights (computed on the distinct
+    # sequences, with their multiplicities, and expanded back to all sequences)
+    iuniq, inverse, mult = sca.uniqueSeqs(msa_num)
+    seqw = sca.seqWeights(msa_num[iuniq], workers=options.jobs, method=options.weights,
+                          mult=mult)[:, inverse]
     effseqs = seqw.sum()
-    msa_num = sca.lett2num(alg)
     Nseq, Npos = msa_num.shape
     print_("Final alignment parameters:")
-    print_("Number of sequences: M = {:d}".format(Nseq))
+    print_("Number of sequences: M = {:d} ({:d} distinct)".format(Nseq, len(iuniq)))
     print_("Number of effective sequences: M' = {:.0f}".format(np.round(effseqs)))
     print_("Number of alignment positions: L = {:d}".format(Npos))
 
@@ -295,6 +297,7 @@ if __name__ == '__main__':
     path_list = options.alignment.split(os.sep)
     fn = path_list[-1]
     fn_noext = fn.split(".")[0]
+    alg = sca.num2lett(msa_num)
     with open(".".join((path.join("Outputs", fn_noext + "processed"), "fasta")), "w") as f:
         for i in range(len(alg)):
             #f.write(">" + hd[i] + "\n")
@@ -306,6 +309,7 @@ if __name__ == '__main__':
     D['hd'] = hd
     D['msa_num'] = msa_num
     D['seqw'] = seqw
+    D['seqw_method'] = options.weights
     D['Nseq'] = Nseq
     D['Npos'] = Npos
     D['ats'] = ats
@@ -16,6 +16,9 @@ The scaSectorID script does the preliminaries of sector identification and store
      --kpos, -k       number of significant eigenmodes for analysis (the default is to automatically choose using the eigenspectrum)
      --cutoff, -p     empirically chosen cutoff for selecting AA positions with a significant contribution to each IC, Default = 0.95
      --matlab, -m     write out the results of this script to a matlab workspace for further analysis
+     --jobs, -j       number of worker processes for the ICA rotations (positions and sequences), Default = 1
+     --precision      working precision for the eigenvectors and the projections: 'double' or 'single', Default: double
+     --ica-batch      minibatch size for the ICA rotations, for very large alignments (see scaTools.rotICA), Default: full iterations
 
 :Example: 
 >>> ./scaSectorID.py PF00071_full.db 
@@ -54,10 +57,16 @@ if __name__ == '__main__':
                         help="number of significant eigenmodes for analysis (the default is to automatically choose using the eigenspectrum)")
     parser.add_argument("-m", "--matlab", action="store_true", dest="matfile", default=False,
                         help="write out the results of this script to a matlab workspace for further analysis")
+    parser.add_argument("-j", "--jobs", dest="jobs", default=1, type=int,
+                        help="number of worker processes for the ICA rotations (positions and sequences), Default = 1")
+    parser.add_argument("--precision", dest="precision", default='double', choices=['double', 'single'],
+                        help="working precision for the eigenvectors and the projections: 'double' or 'single', Default: double")
+    parser.add_argument("--ica-batch", dest="ica_batch", default=None, type=int,
+                        help="minibatch size for the ICA rotations, for very large alignments (see scaTools.rotICA), Default: full iterations")
     options = parser.parse_args()
 
     # extract the necessary stuff from the database...
-    with open(options.database, mode='rt') as db_file:
+    with open(options.database, mode='rb') as db_file:
         db_in = cPickle.load(db_file)
         D_seq = db_in['sequence']
         D_sca = db_in['sca']
@@ -68,23 +77,25 @@ if __name__ == '__main__':
     Csca = D_sca['Csca']
     tX = D_sca['tX']
     Lrand = D_sca['Lrand']
+    dtype = sca.precisionTypes[options.precision]
 
     # run the calculations
-    Vsca, Lsca = sca.eigenVect(Csca)
+    Vsca, Lsca = sca.eigenVect(Csca.astype(dtype))
 
     if (options.kpos == 0):
         kpos = sca.chooseKpos(Lsca, Lrand)
     else:
         kpos = options.kpos
     print_("Selected kpos={} significant eigenmodes.".format(kpos))
-    Vpica, Wpica = sca.rotICA(Vsca, kmax=kpos)
+    Usca = tX.astype(dtype).dot(Vsca[:, :kpos]) / np.sqrt(Lsca[:kpos])
+    # ICA rotations of the positional eigenvectors and of the sequence projections (concurrent):
+    [(Vpica, Wpica), (Usica, Wsica)] = sca.rotICAList([Vsca, Usca], kmax=kpos, workers=options.jobs,
+                                                      batch=options.ica_batch)
     ics, icsize, sortedpos, cutoff, scaled_pd, pd = sca.icList(Vpica, kpos, Csca, p_cut=options.cutoff)
 
-    Usca = tX.dot(Vsca[:, :kpos]).dot(np.diag(1 / np.sqrt(Lsca[:kpos])))
     Upica = Wpica.dot(Usca.T).T
     for k in range(Upica.shape[1]):
         Upica[:, k] /= np.sqrt(Upica[:, k].T.dot(Upica[:, k]))
-    Usica, Wsica = sca.rotICA(Usca, kmax=kpos)
 
     # saving...
     path_list = options.database.split(os.sep)
@@ -95,6 +106,7 @@ if __name__ == '__main__':
     D['Vsca'] = Vsca
     D['Lsca'] = Lsca
     D['kpos'] = kpos
+    D['precision'] = options.precision
     D['Vpica'] = Vpica
     D['Wpica'] = Wpica
     D['Usca'] = Usca
@@ -119,5 +131,5 @@ if __name__ == '__main__':
         savemat(matfile, sca.convert_keys_to_string(sca.convert_values_to_string(db)), oned_as='column')
 
     time.sleep(1)
-    with open(".".join((path.join("Outputs", fn_noext), "db")), mode='wt') as db_out:
+    with open(".".join((path.join("Outputs", fn_noext), "db")), mode='wb') as db_out:
         cPickle.dump(db, db_out, protocol=cPickle.HIGHEST_PROTOCOL)
@@ -19,6 +19,7 @@ from __future__ import (absolute_import, division, unicode_literals)
 from optparse import OptionParser
 import colorsys
 import copy
+import multiprocessing
 import os
 import shutil
 import subprocess
@@ -31,11 +32,13 @@ from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
 from mpl_toolkits.mplot3d import Axes3D
 from scipy.sparse import csr_matrix as sparsify
+from scipy.special import digamma, gammaln
 from scipy.stats import scoreatpercentile
 from scipy.stats import t
 from six import (iterkeys, iteritems, print_)
 import scipy.sparse
 import scipy.sparse.linalg
+import scipy.stats
 
 from six.moves import range
 import matplotlib.cm as cm
@@ -43,7 +46,6 @@ import matplotlib.image as mpimg
 import matplotlib.pyplot as plt
 import numpy as np
 import os.path as path
-import random as rand
 
 
 ##########################################################################
@@ -62,6 +64,21 @@ path2needle = path.join(os.environ['HOME'], 'usr', 'bin')
 
 # Also assumes that a folder named 'Outputs' is in the path
 
+##########################################################################
+# BACKGROUND
+# Background frequencies of the amino acids (ACDEFGHIKLMNPQRSTVWY), for the
+# position weights (posWeights):
+aaFreq0 = np.array([.073, .025, .050, .061, .042, .072, .023, .053, .064, .089,
+                    .023, .043, .052, .040, .052, .073, .056, .063, .013, .033])
+
+##########################################################################
+# PRECISION
+# Working precisions of the large arrays (the dtype keyword of scaMat, seqProj,
+# randomize...), by the names of the --precision option of the scripts: in single
+# precision, the sums over sequences or amino acids that need it are accumulated
+# in double precision.
+precisionTypes = {'double': np.float64, 'single': np.float32}
+
 ##########################################################################
 # CLASSES
 
@@ -100,6 +117,256 @@ class Annot(object):
         self.taxo = taxo
         self.seq = seq
 
+
+class BitAlg(object):
+    ''' A bit-packed alignment, for fast computation of sequence identities. The residue codes
+    of an alignment in numeric representation (lett2num_) are split into bit planes that are
+    packed 64 positions to a word, so that the number of identical positions between two
+    sequences is obtained with XOR/OR and popcount over L/64 words per plane. This takes about
+    16 times less memory than the sparse binary alignment (alg2bin_). seqWeights_, seqSim_,
+    chooseRefSeq_ and filterSeq_ accept a BitAlg in place of the numeric alignment.
+
+    .. _lett2num: scaTools.html#scaTools.lett2num
+    .. _alg2bin: scaTools.html#scaTools.alg2bin
+    .. _seqWeights: scaTools.html#scaTools.seqWeights
+    .. _seqSim: scaTools.html#scaTools.seqSim
+    .. _chooseRefSeq: scaTools.html#scaTools.chooseRefSeq
+    .. _filterSeq: scaTools.html#scaTools.filterSeq
+
+        **Attributes:**
+            -  `planes` = the bits of the residue codes (array of 64-bit words, W x Nbits x M)
+            -  `gaps`   = the positions with code 0, i.e. the gaps (array of 64-bit words, W x M)
+            -  `shape`  = the dimensions (M, L) of the alignment
+
+        :Example:
+          >>> bitalg = BitAlg(msa_num)
+          >>> seqw = seqWeights(bitalg)
+    '''
+
+    def __init__(self, msa_num):
+        msa_num = np.asarray(msa_num)
+        Nbits = max(1, int(msa_num.max()).bit_length())
+        self.shape = msa_num.shape
+        self.planes = np.stack([packBits((msa_num >> b) & 1) for b in range(Nbits)], axis=1)
+        self.gaps = packBits(msa_num == 0)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, rows):
+        ''' Sub-alignment with the sequences in rows (a slice or a list of indices). '''
+        sub = copy.copy(self)
+        sub.planes = self.planes[:, :, rows]
+        sub.gaps = self.gaps[:, rows]
+        sub.shape = (sub.gaps.shape[1], self.shape[1])
+        return sub
+
+    def num(self):
+        ''' The alignment in numeric representation (uint8, M x L). '''
+        Nseq, Npos = self.shape
+        msa_num = np.zeros((Nseq, Npos), dtype=np.uint8)
+        for b in range(self.planes.shape[1]):
+            words = np.ascontiguousarray(self.planes[:, b, :].T).view(np.uint8)
+            msa_num |= np.unpackbits(words, axis=1, bitorder='little')[:, :Npos] << b
+        return msa_num
+
+    def gapCount(self):
+        ''' Number of gaps in each sequence. '''
+        return popcount(self.gaps).sum(axis=0, dtype=np.int64)
+
+    def identity(self, rows, gaps=True):
+        ''' Number of identical positions between all the sequences and the sequences in rows
+        (an M x len(rows) integer array). If gaps is False, aligned gaps are not counted as
+        identities.'''
+        cols = self.planes[:, :, rows]
+        Nseq, Ncol = self.shape[0], cols.shape[2]
+        mismatches = np.zeros((Nseq, Ncol), dtype=np.int64)
+        for w in range(self.planes.shape[0]):
+            diff = np.zeros((Nseq, Ncol), dtype=np.uint64)
+            for b in range(self.planes.shape[1]):
+                diff |= self.planes[w, b][:, None] ^ cols[w, b][None, :]
+            mismatches += popcount(diff)
+        if not gaps:
+            gapcols = self.gaps[:, rows]
+            for w in range(self.gaps.shape[0]):
+                mismatches += popcount(self.gaps[w][:, None] & gapcols[w][None, :])
+        return self.shape[1] - mismatches
+
+    def pairIdentity(self, seq1, seq2, gaps=True):
+        ''' Number of identical positions between the pairs of sequences (seq1[p], seq2[p]),
+        for two arrays of sequence indices. If gaps is False, aligned gaps are not counted.'''
+        mismatches = np.zeros(len(seq1), dtype=np.int64)
+        for w in range(self.planes.shape[0]):
+            diff = np.zeros(len(seq1), dtype=np.uint64)
+            for b in range(self.planes.shape[1]):
+                diff |= self.planes[w, b][seq1] ^ self.planes[w, b][seq2]
+            mismatches += popcount(diff)
+            if not gaps:
+                mismatches += popcount(self.gaps[w][seq1] & self.gaps[w][seq2])
+        return self.shape[1] - mismatches
+
+
+class PairFreq(object):
+    ''' The joint frequencies of amino acids at pairs of positions (freq2 of freq_), computed on
+    demand from the sparse binary alignment (alg2bin_): the (Naa L) x (Naa L) matrix
+    (1 - lbda) X^T D X + lbda B, with X the binary alignment, D the diagonal matrix of normalized
+    sequence weights and B the block-diagonal background (blocks outer(freq0, freq0)), is never
+    stored. Blocks (i, j) of Naa x Naa frequencies, or slabs of rows of blocks, are computed when
+    needed (tiles of positions I x J), and the background is only added to the diagonal blocks.
+    Used by scaMat_ and directInfo_.
+
+    .. _freq: scaTools.html#scaTools.freq
+    .. _scaMat: scaTools.html#scaTools.scaMat
+    .. _directInfo: scaTools.html#scaTools.directInfo
+
+        **Attributes:**
+            -  `XwT`  = the weighted binary alignment X^T D (sparse, Naa L x M)
+            -  `X`    = the binary alignment (sparse, M x Naa L, stored by columns)
+            -  `bkg`  = the background block outer(freq0, freq0) (Naa x Naa)
+            -  `lbda`, `Naa`, `Npos`
+            -  `shape` = the dimensions (Naa L, Naa L) of the matrix
+
+    The binary alignment can be given (Abin) if already computed. The frequencies are computed and
+    returned with the given dtype (np.float32 halves the memory; the sums over the sequences are
+    made by the sparse products, with an error of about 1e-7 relative to the frequencies).
+
+        :Example:
+          >>> freq2 = PairFreq(msa_num, seqw, lbda=0.03)
+          >>> f2ij = freq2.block(i, j)
+    '''
+
+    def __init__(self, alg, seqw=1, Naa=20, lbda=0, freq0=np.ones(20) / 21, mult=None, Abin=None, dtype=float):
+        Nseq, Npos = alg.shape
+        if type(seqw) == int and seqw == 1:
+            seqw = np.ones((1, Nseq))
+        if mult is not None:
+            seqw = seqw * mult
+        seqwn = seqw / seqw.sum()
+        X = alg2bin(alg, Naa, dtype=np.uint8) if Abin is None else Abin
+        self.XwT = sparsify(X.T.dot(scipy.sparse.diags(seqwn[0], 0)), dtype=dtype)
+        self.X = X.tocsc()
+        self.bkg = np.outer(freq0, freq0).astype(dtype)
+        self.lbda, self.Naa, self.Npos = lbda, Naa, Npos
+        self.shape = (Naa * Npos, Naa * Npos)
+
+    def tile(self, posI, posJ):
+        ''' The joint frequencies of the positions in posI with the positions in posJ (slices or
+        lists of positions), as a dense (Naa len(posI)) x (Naa len(posJ)) array. '''
+        posI, posJ = np.arange(self.Npos)[posI], np.arange(self.Npos)[posJ]
+        Naa = self.Naa
+        rows = (Naa * posI[:, None] + np.arange(Naa)).ravel()
+        cols = (Naa * posJ[:, None] + np.arange(Naa)).ravel()
+        freq2 = self.XwT[rows].dot(self.X[:, cols]).toarray()
+        if self.lbda > 0:
+            freq2 *= 1 - self.lbda
+            common, kI, kJ = np.intersect1d(posI, posJ, return_indices=True)
+            for k1, k2 in zip(kI, kJ):
+                freq2[Naa * k1:Naa * (k1 + 1), Naa * k2:Naa * (k2 + 1)] += self.lbda * self.bkg
+        return freq2
+
+    def slab(self, pos):
+        ''' Rows of the matrix for the positions in pos (a slice or a list of positions), as a
+        dense (Naa len(pos)) x (Naa L) array. '''
+        return self.tile(pos, slice(None))
+
+    def block(self, i, j):
+        ''' The Naa x Naa block of joint frequencies of positions i and j. '''
+        return self.tile([i], [j])
+
+    def full(self):
+        ''' The whole (Naa L) x (Naa L) matrix, as a dense array. '''
+        return self.tile(slice(None), slice(None))
+
+##########################################################################
+# PARALLELIZATION
+
+# Data shared with the worker processes of poolMap (set once per worker):
+_poolData = dict()
+
+
+def poolMap(func, tasks, workers=1, data=None):
+    ''' Compute func(data, task) for every task in the list tasks and return the results in the
+    same order. If workers > 1 (or None, for all available cores) the tasks are distributed over
+    a pool of worker processes. The (possibly large) data is handed to each worker once when the
+    pool starts rather than with every task, so func should be a module-level function that only
+    receives small task descriptions (e.g. slices).
+
+    :Example:
+       >>> counts = poolMap(seqWeightsBlock, blocks, workers=4, data={'X2d': X2d}) '''
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers <= 1 or len(tasks) <= 1:
+        return [func(data, task) for task in tasks]
+    pool = multiprocessing.Pool(min(workers, len(tasks)), poolInit, (data,))
+    try:
+        return pool.map(poolTask, [(func, task) for task in tasks], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def poolIter(func, tasks, workers=1, data=None):
+    ''' Like poolMap_, but yield the pairs (task, func(data, task)) as the results arrive (in any
+    order when workers > 1), so that they can be consumed without keeping all of them in memory.
+    If the iteration is stopped early, the remaining tasks are cancelled.
+
+    .. _poolMap: scaTools.html#scaTools.poolMap
+
+    :Example:
+       >>> for (I, J), (Ctile, Ptile) in poolIter(scaTile, tiles, workers=4, data=data): ... '''
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            yield task, func(data, task)
+        return
+    pool = multiprocessing.Pool(min(workers, len(tasks)), poolInit, (data,))
+    complete = False
+    try:
+        for result in pool.imap_unordered(poolTaskPair, [(func, task) for task in tasks], chunksize=1):
+            yield result
+        complete = True
+    finally:
+        if complete:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
+
+
+def poolInit(data):
+    ''' Store the shared data in a worker process (called by poolMap_).
+
+    .. _poolMap: scaTools.html#scaTools.poolMap '''
+    _poolData['data'] = data
+
+
+def poolTask(args):
+    ''' Run one task in a worker process (called by poolMap_). '''
+    func, task = args
+    return func(_poolData['data'], task)
+
+
+def poolTaskPair(args):
+    ''' Run one task in a worker process and return it with its result (called by poolIter_).
+
+    .. _poolIter: scaTools.html#scaTools.poolIter '''
+    func, task = args
+    return task, func(_poolData['data'], task)
+
+
+def rowBlocks(Nrows, nb, workers=1):
+    ''' Split range(Nrows) into consecutive slices of at most nb rows, using at least four
+    blocks per worker when workers > 1 so that the load is balanced.
+
+    :Example:
+       >>> blocks = rowBlocks(Nseq, nb, workers=4) '''
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers > 1:
+        nb = max(1, min(nb, -(-Nrows // (4 * workers))))
+    return [slice(start, min(start + nb, Nrows)) for start in range(0, Nrows, nb)]
+
 ##########################################################################
 # ALIGNMENT PROCESSING
 
@@ -126,6 +393,156 @@ def readAlg(filename):
     return headers, sequences
 
 
+def readAlgBytes(filename):
+    ''' Read in a multiple sequence alignment in fasta format in bulk, and return the
+    headers and an MxL array of upper-cased residue characters (as uint8 byte codes).
+    The sequence strings are never built one by one, so this is much faster than
+    readAlg_ for large alignments. All sequences must have the same length.
+
+    .. _readAlg: scaTools.html#scaTools.readAlg
+
+    >>> headers, msa_bytes = readAlgBytes(filename) '''
+    with open(filename, 'rb') as alnfile:
+        data = alnfile.read().lstrip()
+    headers = list()
+    sequences = list()
+    for record in data[1:].split(b'\n>'):
+        header, _, seq = record.partition(b'\n')
+        headers.append(header.rstrip(b'\r').decode())
+        sequences.append(seq.translate(None, b' \t\r\n'))
+    Npos = len(sequences[0])
+    if any(len(seq) != Npos for seq in sequences):
+        raise ValueError('The sequences in {} are not all of the same length'.format(filename))
+    msa_bytes = np.frombuffer(b''.join(sequences).upper(), dtype=np.uint8)
+    return headers, msa_bytes.reshape(len(sequences), Npos)
+
+
+def bytes2num(msa_bytes, code='ACDEFGHIKLMNPQRSTVWY'):
+    ''' Translate an alignment of residue characters (as returned by readAlgBytes_) to
+    the numeric representation of lett2num_, using a byte lookup table. The output
+    is a uint8 array where the amino acids in code are represented by 1,...,len(code)
+    and any other symbol by 0.
+
+    .. _readAlgBytes: scaTools.html#scaTools.readAlgBytes
+    .. _lett2num: scaTools.html#scaTools.lett2num
+
+    :Example:
+       >>> msa_num = bytes2num(msa_bytes, code='ACDEFGHIKLMNPQRSTVWY')
+
+    '''
+    table = np.zeros(256, dtype=np.uint8)
+    for i, aa in enumerate(code):
+        table[ord(aa)] = i + 1
+    return table[msa_bytes]
+
+
+def readAlgNum(filename, code='ACDEFGHIKLMNPQRSTVWY'):
+    ''' Read in a multiple sequence alignment in fasta format, and return the headers
+    and the alignment in numeric representation (uint8). This is a drop-in replacement
+    for readAlg_ followed by lett2num_ that skips the Python strings entirely.
+
+    :Example:
+       >>> headers, msa_num = readAlgNum(filename) '''
+    headers, msa_bytes = readAlgBytes(filename)
+    return headers, bytes2num(msa_bytes, code)
+
+
+def packBits(mask):
+    ''' Pack an MxL boolean array along the positions into 64-bit words, and return them as
+    an array of dimensions ceil(L/64) x M (the words for each sequence are in a column, so that
+    one word of all sequences is contiguous). Called by BitAlg_.
+
+    .. _BitAlg: scaTools.html#scaTools.BitAlg
+
+    :Example:
+       >>> words = packBits(msa_num == 0) '''
+    Nseq, Npos = mask.shape
+    packed = np.zeros((Nseq, 8 * (-(-Npos // 64))), dtype=np.uint8)
+    packed[:, :-(-Npos // 8)] = np.packbits(mask, axis=1, bitorder='little')
+    return np.ascontiguousarray(packed.view(np.uint64).T)
+
+
+def popcount(words):
+    ''' Number of bits set in each element of an array of 64-bit words.
+
+    :Example:
+       >>> nbits = popcount(words) '''
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words)
+    # Older numpy: counts of the 8 bytes of each word from a lookup table
+    table = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+    nbits = table[np.ascontiguousarray(words).view(np.uint8)]
+    return nbits.reshape(words.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+
+def lett2bytes(sequences):
+    ''' Translate a list of (aligned) sequences to an MxL array of byte codes, the
+    representation returned by readAlgBytes_.
+
+    :Example:
+       >>> msa_bytes = lett2bytes(sequences) '''
+    msa_bytes = np.frombuffer(''.join(sequences).encode(), dtype=np.uint8)
+    return msa_bytes.reshape(len(sequences), -1)
+
+
+def num2lett(msa_num, code='ACDEFGHIKLMNPQRSTVWY', gap='-'):
+    ''' Translate an alignment in numeric representation back to a list of sequences
+    (the inverse of lett2num_), with 0 represented by the gap character.
+
+    :Example:
+       >>> sequences = num2lett(msa_num) '''
+    table = np.frombuffer((gap + code).encode(), dtype=np.uint8)
+    msa_bytes = table[np.asarray(msa_num)]
+    return [seq.tobytes().decode() for seq in msa_bytes]
+
+
+def uniqueSeqs(alg, max_mem=2**30):
+    ''' Collapse the identical sequences of an alignment (a list of sequences, an MxL alignment
+    in numeric representation or a BitAlg_). Each sequence is hashed as a 64-bit random linear
+    combination of its codes, the hashes are sorted, and the sequences of each group of equal
+    hashes are checked to be identical (a full comparison of the rows is only made in the
+    unlikely case of a hash collision).
+
+    **Returns:**
+        -  `index` = the index of the first occurrence of each distinct sequence
+        -  `inverse` = for each sequence, the index of its distinct sequence, so that
+                       alg[index][inverse] is alg
+        -  `mult` = the multiplicity of each distinct sequence
+
+    Quantities computed on the distinct sequences with the multiplicities (see seqWeights_,
+    freq_ and posWeights_) are expanded back to the whole alignment with the inverse index.
+
+    .. _freq: scaTools.html#scaTools.freq
+    .. _posWeights: scaTools.html#scaTools.posWeights
+
+    :Example:
+       >>> index, inverse, mult = uniqueSeqs(msa_num)
+       >>> seqw = seqWeights(msa_num[index], mult=mult)[:, inverse] '''
+    if isinstance(alg, BitAlg):
+        rows = alg.planes.reshape(-1, len(alg)).T
+    elif isinstance(alg, np.ndarray):
+        rows = alg
+    else:
+        rows = lett2bytes(alg)
+    Nseq, Ncol = rows.shape
+    rng = np.random.default_rng(0)
+    coeffs = rng.integers(0, 2**63, Ncol, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    blocks = rowBlocks(Nseq, blockSize(Nseq, 8 * Ncol, max_mem))
+    hashes = np.zeros(Nseq, dtype=np.uint64)
+    for block in blocks:
+        hashes[block] = (rows[block].astype(np.uint64) * coeffs).sum(axis=1)
+    _, index, inverse, mult = np.unique(hashes, return_index=True, return_inverse=True,
+                                        return_counts=True)
+    inverse = inverse.ravel()
+    if any((rows[block] != rows[index[inverse[block]]]).any() for block in blocks):
+        rows = np.ascontiguousarray(rows)
+        rows = rows.view(np.dtype((np.void, rows.dtype.itemsize * Ncol))).ravel()
+        _, index, inverse, mult = np.unique(rows, return_index=True, return_inverse=True,
+                                            return_counts=True)
+        inverse = inverse.ravel()
+    return index, inverse, mult
+
+
 def AnnotPfam(pfam_in, pfam_out, pfam_seq=path2pfamseq):
     ''' Phylogenetic annotation of a Pfam alignment (in fasta format) using information from pfamseq.txt (ftp://ftp.sanger.ac.uk/pub/databases/Pfam/current_release/database_files/). The output is a fasta file containing phylogenetic annotations in the header (to be parsed with '|' as a delimiter).
 
@@ -276,27 +693,72 @@ def MSAsearch(hd, algn, seq, species=None, path2_algprog=path2needle):
             return strseqnum
 
 
-def chooseRefSeq(alg):
+def chooseRefSeq(alg, workers=1, method='freq', Nsample=1000):
     ''' This function chooses a default reference sequence if none is given by taking the
     sequence which has the mean pairwise sequence identity closest to that of the entire alignment.
+    The alignment can be given as a list of sequences, in numeric representation (lett2num_)
+    or as a BitAlg_.
+
+    **Keyword Arguments:**
+        -  `method` = 'freq' (default): the mean identities are computed over the whole alignment
+                      from the residue counts at each position, in O(ML) (the summed identities
+                      of a sequence to all the others are the counts of its residues);
+                      'sample': the mean identities are computed from the similarity matrix (seqSim_)
+                      of Nsample sequences drawn with their weights (randSel_), if there are more.
+        -  `workers` = number of worker processes for the weights and similarities of the 'sample'
+                       method.
+
+    .. _randSel: scaTools.html#scaTools.randSel
 
     :Example:
        >>> i_ref = chooseRefSeq(msa_num)'''
 
-    if (len(alg) > 1000):
-        seqw = seqWeights(alg)
-        keep_seq = randSel(seqw, 1000)
+    if method == 'sample':
+        return chooseRefSeqSample(alg, workers, Nsample)
+    if isinstance(alg, BitAlg):
+        msa = alg.num()
+    elif isinstance(alg, np.ndarray):
+        msa = alg
+    else:
+        msa = bytes2num(lett2bytes(alg))
+    Nseq, Npos = msa.shape
+    # Summed identities (gaps excluded, self included) of each sequence to all sequences:
+    sumid = np.zeros(Nseq, dtype=np.int64)
+    sumsq = 0
+    for pos in range(Npos):
+        counts = np.bincount(msa[:, pos], minlength=21)
+        counts[0] = 0
+        sumid += counts[msa[:, pos]]
+        sumsq += counts.dot(counts)
+    # Mean identities to all sequences, and mean identity over the pairs of distinct sequences:
+    meanSID = sumid / (Nseq * Npos)
+    meanPair = (sumsq - (msa > 0).sum()) / (Npos * Nseq * (Nseq - 1))
+    return int(np.argmin(abs(meanSID - meanPair)))
+
+
+def chooseRefSeqSample(alg, workers=1, Nsample=1000):
+    ''' Reference sequence chosen as in chooseRefSeq_, from the similarity matrix of a weighted
+    random sample of Nsample sequences. Called by chooseRefSeq_ (method='sample').
+
+    :Example:
+       >>> i_ref = chooseRefSeqSample(msa_num, Nsample=1000)'''
+
+    if (len(alg) > Nsample):
+        seqw = seqWeights(alg, workers=workers)
+        keep_seq = randSel(seqw, Nsample)
     else:
         keep_seq = [k for k in range(len(alg))]
-    algNew = [alg[k] for k in keep_seq]
-    numAlgNew = lett2num(algNew)
-    simMat = seqSim(numAlgNew)
+    if isinstance(alg, (np.ndarray, BitAlg)):
+        numAlgNew = alg[keep_seq]
+    else:
+        numAlgNew = lett2num([alg[k] for k in keep_seq])
+    simMat = seqSim(numAlgNew, workers=workers)
     listS = [simMat[i, j] for i in range(simMat.shape[0]) for j in range(i + 1, simMat.shape[1])]
     meanSID = [simMat[k].mean() for k in range(len(simMat))]
     meanDiff = abs(meanSID - np.mean(listS))
     strseqnum = [i for i, k in enumerate(meanDiff) if k == min(meanDiff)]
     ix = keep_seq[strseqnum[0]]
-    return strseqnum[0]
+    return ix
 
 
 def makeATS(sequences, refpos, refseq, iref=0, truncate=False):
@@ -306,7 +768,7 @@ def makeATS(sequences, refpos, refseq, iref=0, truncate=False):
     .. _MSAsearch: scaTools.html#scaTools.MSAsearch
 
      **Arguments:**
-       -  sequences
+       -  sequences (a list of sequences, or an MxL alignment in numeric representation)
        -  reference positions 
        -  reference sequence
        -  iref, the index of the sequence in the alignment with the highest identity to the reference
@@ -318,17 +780,20 @@ def makeATS(sequences, refpos, refseq, iref=0, truncate=False):
       >>> sequences_trun, ats_new = sca.makeATS(sequences_full, ats_pdb, seq_pdb, i_ref)
 
     '''
+    if isinstance(sequences, np.ndarray):
+        seq_iref = num2lett(sequences[[iref]])[0]
+    else:
+        seq_iref = sequences[iref]
     if truncate == True:
         print_("truncating to reference sequence...")
         # Removing gaps:
         pos_ref = [i for i, a in enumerate(refseq) if a != '-']
         seq_ref = ''.join([refseq[i] for i in pos_ref])
         ats_ref = [refpos[i] for i in pos_ref]
-        pos_alg = [i for i, a in enumerate(sequences[iref]) if a != '-']
-        seq_tr = [''.join([sq[i] for i in pos_alg]) for sq in sequences]
+        pos_alg = [i for i, a in enumerate(seq_iref) if a != '-']
         # Positions to keep in the alignment and pbd sequences
         # (no gap in any of them after co-alignment):
-        seqal_ref, seqal_alg, _, _, _ = pairwise2.align.globalms(seq_ref, seq_tr[iref],
+        seqal_ref, seqal_alg, _, _, _ = pairwise2.align.globalms(seq_ref, ''.join([seq_iref[i] for i in pos_alg]),
                                                                  2, -1, -.5, -.1)[0]
         keep_ref, keep_alg = list(), list()
         j_ref, j_alg = 0, 0
@@ -340,15 +805,19 @@ def makeATS(sequences, refpos, refseq, iref=0, truncate=False):
                 j_ref += 1
             if seqal_alg[i] != '-':
                 j_alg += 1
-        sequences_out = [''.join([sq[i] for i in keep_alg]) for sq in seq_tr]
+        keep_pos = [pos_alg[i] for i in keep_alg]
+        if isinstance(sequences, np.ndarray):
+            sequences_out = sequences[:, keep_pos]
+        else:
+            sequences_out = [''.join([sq[i] for i in keep_pos]) for sq in sequences]
         ats_out = [ats_ref[i] for i in keep_ref]
     else:
-        tmp = sequences[iref].replace('-', '.')
+        tmp = seq_iref.replace('-', '.')
         refseq = refseq.replace('-', '')
         seqal_ref, seqal_alg, _, _, _ = pairwise2.align.globalms(refseq, tmp,
                                                                  2, -1, -.5, -.1)[0]
         print ('Len refseq %i, len refpos %i, Len alg seq %i, len pairalg %i, len gloalg %i'
-               % (len(refseq), len(refpos), len(tmp), len(seqal_alg), len(sequences[0])))
+               % (len(refseq), len(refpos), len(tmp), len(seqal_alg), len(seq_iref)))
         # print seqal_ref
         # print seqal_alg
         ats_out = list()
@@ -396,50 +865,327 @@ def lett2num(msa_lett, code='ACDEFGHIKLMNPQRSTVWY'):
     return msa_num
 
 
-def alg2bin(alg, N_aa=20):
+def alg2bin(alg, N_aa=20, dtype=float):
     ''' Translate an alignment of size M x L where the amino acids are represented 
     by numbers between 0 and N_aa (obtained using lett2num) to a sparse binary 
-    array of size M x (N_aa x L). 
+    array of size M x (N_aa x L), where amino acid a at position i is column N_aa*i + a-1.
+    The CSR arrays are built directly from the alignment, in O(ML) memory; the data can be
+    given a smaller dtype (np.uint8 or bool), as long as it is not used in integer products
+    that could overflow.
 
     :Example:
       >>> Abin = alg2bin(alg, N_aa=20) '''
 
     [N_seq, N_pos] = alg.shape
-    Abin_tens = np.zeros((N_aa, N_pos, N_seq))
-    for ia in range(N_aa):
-        Abin_tens[ia, :, :] = (alg == ia + 1).T
-    Abin = sparsify(Abin_tens.reshape(N_aa * N_pos, N_seq, order='F').T)
+    nonzero = (alg > 0) & (alg <= N_aa)
+    indptr = np.r_[0, np.cumsum(nonzero.sum(axis=1))]
+    indices = (N_aa * np.arange(N_pos) + alg.astype(np.int64) - 1)[nonzero]
+    data = np.ones(len(indices), dtype=dtype)
+    Abin = sparsify((data, indices, indptr), shape=(N_seq, N_aa * N_pos))
     return Abin
 
 
-def seqWeights(alg, max_seqid=.8, gaps=1):
+def scaleSparse(X, rows=None, cols=None, dtype=float):
+    ''' Scale the rows and/or the columns of a sparse matrix X (e.g. from alg2bin_) by the vectors
+    rows and cols, i.e. compute diag(rows) X diag(cols) element-wise on the stored values, without
+    diagonal matrices. Returns a new CSR matrix of the given dtype.
+
+    .. _alg2bin: scaTools.html#scaTools.alg2bin
+
+    :Example:
+      >>> X2dw = scaleSparse(X2d, rows=np.sqrt(seqw[0])) '''
+    X = sparsify(X, dtype=dtype, copy=True)
+    if rows is not None:
+        X.data *= np.repeat(np.asarray(rows, dtype=dtype), np.diff(X.indptr))
+    if cols is not None:
+        X.data *= np.asarray(cols, dtype=dtype)[X.indices]
+    return X
+
+
+def blockSize(Nrows, rowbytes, max_mem=2**30):
+    ''' Number of rows of a block computation that fit in a memory budget of max_mem
+    bytes, given the memory used per row (at least 1, at most Nrows).
+
+    :Example:
+       >>> nb = blockSize(Nseq, 16 * Nseq, max_mem=2**30) '''
+    return int(max(1, min(Nrows, max_mem // max(1, rowbytes))))
+
+
+def seqBits(alg, gaps=1):
+    ''' Bit-packed form of an alignment for the sequence weights, and whether an aligned code
+    0 counts as an identity (for numeric alignments 0 is the gap, which is an identity if gaps == 1;
+    sequences given as strings are coded with the gap as a 21st amino acid if gaps == 1 and 0 for
+    other symbols). Called by seqWeights_ and seqWeightsLSH_.
+
+    .. _seqWeightsLSH: scaTools.html#scaTools.seqWeightsLSH
+
+    :Example:
+      >>> bitalg, gapid = seqBits(alg, gaps=1) '''
+    codeaa = 'ACDEFGHIKLMNPQRSTVWY'
+    if gaps == 1:
+        codeaa += '-'
+    if isinstance(alg, BitAlg):
+        return alg, gaps == 1
+    elif isinstance(alg, np.ndarray):
+        return BitAlg(alg), gaps == 1
+    else:
+        return BitAlg(lett2num(alg, code=codeaa)), False
+
+
+def seqWeights(alg, max_seqid=.8, gaps=1, max_mem=2**30, workers=1, method='exact', mult=None):
     ''' Compute sequence weights for an alignment (format: list of sequences)
     where the weight of a sequence is the inverse of the number of sequences in
     its neighborhood, defined as the sequences with sequence similarity below
     max_seqid. The sum of the weights defines an effective number of sequences.
 
     **Arguments:**
-        -  `alg` = list of sequences
+        -  `alg` = list of sequences, or MxL alignment in numeric representation (lett2num_) or
+                   as a BitAlg_, in which case 0 is taken to be the gap
 
     **Keyword Arguments:**
         -  `max_seqid` 
         -  `gaps` = If gaps == 1 (default), considering gaps as a 21st amino acid, if gaps == 0, not considering them.
+        -  `max_mem` = memory budget in bytes. The similarities are computed by blocks of sequences
+                       against the whole alignment, and only the number of neighbors of each sequence is
+                       kept, so that the MxM similarity matrix is never built.
+        -  `workers` = number of worker processes for the blocks (None for all cores); the
+                       weights do not depend on it.
+        -  `method` = 'exact' (default), or 'lsh' for the approximate weights of seqWeightsLSH_
+                      (with default parameters, and max_mem and workers), for very large alignments. The error of the
+                      approximation, estimated on a sample of sequences, is printed.
+        -  `mult` = multiplicities of the sequences, when alg holds the distinct sequences of an
+                    alignment (see uniqueSeqs_): each sequence then counts as mult neighbors, and
+                    the weights are those of each copy in the whole alignment.
+
+    .. _uniqueSeqs: scaTools.html#scaTools.uniqueSeqs
 
     :Example:
       >>> seqw = seqWeights(alg)    
 
     '''
-    codeaa = 'ACDEFGHIKLMNPQRSTVWY'
-    if gaps == 1:
-        codeaa += '-'
-    msa_num = lett2num(alg, code=codeaa)
-    X2d = alg2bin(msa_num, N_aa=len(codeaa))
-    simMat = (X2d.dot(X2d.T)).todense() / msa_num.shape[1]
-    seqw = np.array(1 / (simMat > max_seqid).sum(axis=0))
+    if method == 'lsh':
+        seqw, err = seqWeightsLSH(alg, max_seqid, gaps, mult=mult, max_mem=max_mem, workers=workers)
+        print_("LSH sequence weights, relative error on {:d} sampled sequences: max {:.3g}, mean {:.3g}, "
+               "effective number of sequences {:.3g}".format(err['Nsample'], err['max'], err['mean'], err['effseqs']))
+        return seqw
+    bitalg, gapid = seqBits(alg, gaps)
+    Nseq, Npos = bitalg.shape
+    # Per sequence of a block: columns of identity counts, of packed words
+    # and of similarities (float + boolean):
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    nb = blockSize(Nseq, 33 * Nseq, max_mem // max(1, workers))
+    blocks = rowBlocks(Nseq, nb, workers)
+    counts = poolMap(seqWeightsBlock, blocks, workers,
+                     {'bitalg': bitalg, 'gaps': gapid, 'max_seqid': max_seqid, 'mult': mult})
+    seqw = np.array(1 / np.concatenate(counts), ndmin=2)
     return seqw
 
 
-def filterSeq(alg0, sref=0.5, max_fracgaps=.2, min_seqid=.2, max_seqid=.8):
+def seqWeightsBlock(data, block):
+    ''' Number of neighbors (similarity above max_seqid) of each sequence in a block of the
+    alignment. Called by seqWeights_.
+
+    .. _seqWeights: scaTools.html#scaTools.seqWeights '''
+    bitalg = data['bitalg']
+    simBlock = bitalg.identity(block, data['gaps']) / bitalg.shape[1]
+    if data['mult'] is None:
+        return (simBlock > data['max_seqid']).sum(axis=0)
+    return data['mult'].dot(simBlock > data['max_seqid'])
+
+
+def seqWeightsLSH(alg, max_seqid=.8, gaps=1, kmer=2, Nbands=48, bandsize=3, Nsample=100, seed=0,
+                  mult=None, max_mem=2**30, workers=1, max_bucket=1000):
+    ''' Approximate sequence weights (as in seqWeights_) for very large alignments, where the
+    exact O(M^2 L) computation is not tractable. Candidate neighbors are found by locality
+    sensitive hashing: each sequence is described by the set of its k-mers tagged with their
+    positions, summarized by Nbands x bandsize MinHash values, and two sequences are candidates if
+    all the values of at least one band are equal. Only the candidate pairs are compared exactly,
+    so that neighbors can be missed (with a low probability for similarities above max_seqid) but
+    never added: the approximate weights are upper bounds of the exact ones. The error is
+    estimated by computing exactly the weights of Nsample randomly chosen sequences.
+
+    The signatures are computed by blocks of sequences, and the candidate pairs band by band and
+    by chunks, within the memory budget max_mem. The sequences of a bucket larger than max_bucket
+    (e.g. a large family of close sequences) are split at random into groups of at most
+    max_bucket sequences, and only the pairs within the groups are candidates, so that the
+    number of pairs is at most linear in M (the neighbors then missed show in the error
+    estimate). Each pair is verified in the first band where it is in a group (lshGroups_), so
+    that the list of all the candidate pairs is never built.
+
+    .. _lshGroups: scaTools.html#scaTools.lshGroups
+
+    **Arguments:**
+        -  `alg` = alignment, in any of the forms accepted by seqWeights_
+
+    **Keyword Arguments:**
+        -  `max_seqid`, `gaps`, `mult` = as in seqWeights_
+        -  `kmer` = length of the position-tagged k-mers
+        -  `Nbands`, `bandsize` = number and size of the bands of MinHash values (more bands
+                                  increase the chance to find neighbors, and the number of
+                                  candidates; larger bands decrease both)
+        -  `Nsample` = number of sequences for the error estimate
+        -  `seed` = seed of the random number generator (hash functions, groups and sample)
+        -  `max_mem` = memory budget in bytes of the blocks of sequences and chunks of pairs
+        -  `workers` = number of worker processes for the blocks of sequences and the bands
+                       (None for all cores); the weights do not depend on it.
+        -  `max_bucket` = maximal number of sequences of a bucket whose pairs are all candidates
+
+    **Returns:**
+        -  `seqw` = the approximate sequence weights (1xM)
+        -  `err` = dictionary with the relative errors on the sampled sequences: 'max' and 'mean'
+                   for the weights, 'effseqs' for their sum, and 'Nsample'
+
+    :Example:
+      >>> seqw, err = seqWeightsLSH(alg, max_seqid=.8)
+
+    '''
+    rng = np.random.default_rng(seed)
+    bitalg, gapid = seqBits(alg, gaps)
+    Nseq, Npos = bitalg.shape
+    if mult is None:
+        mult = np.ones(Nseq, dtype=np.int64)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    # Keys of the bands of the signatures:
+    sig = minHash(bitalg, kmer, Nbands * bandsize, rng, max_mem, workers)
+    keys = lshKeys(sig, Nbands, bandsize, rng)
+    del sig
+    groups = lshGroups(keys, max_bucket, seed)
+    del keys
+    # Exact verification of the candidates, band by band:
+    selfid = np.full(Nseq, Npos) if gapid else Npos - bitalg.gapCount()
+    counts = mult * (selfid / Npos > max_seqid)
+    data = {'bitalg': bitalg, 'gaps': gapid, 'max_seqid': max_seqid, 'mult': mult, 'groups': groups,
+            'max_mem': max_mem // max(1, workers)}
+    for band, bandcounts in poolIter(lshBand, list(range(Nbands)), workers, data):
+        counts += bandcounts
+    seqw = np.array(1 / counts, ndmin=2)
+    # Error estimate on a sample:
+    sample = np.sort(rng.choice(Nseq, min(Nsample, Nseq), replace=False))
+    seqw_ex = 1 / mult.dot(bitalg.identity(sample, gapid) / Npos > max_seqid)
+    relerr = (seqw[0, sample] - seqw_ex) / seqw_ex
+    err = {'Nsample': len(sample), 'max': relerr.max(), 'mean': relerr.mean(),
+           'effseqs': mult[sample].dot(seqw[0, sample]) / mult[sample].dot(seqw_ex) - 1}
+    return seqw, err
+
+
+def minHash(bitalg, kmer, Nhash, rng, max_mem=2**30, workers=1):
+    ''' MinHash signatures (M x Nhash, uint32) of the sets of position-tagged k-mers of the
+    sequences of an alignment (a BitAlg_), computed by blocks of sequences within the memory
+    budget max_mem (by workers processes). Called by seqWeightsLSH_.
+
+    :Example:
+      >>> sig = minHash(bitalg, 2, 144, np.random.default_rng(0)) '''
+    Nseq, Npos = bitalg.shape
+    Nkmer = Npos - kmer + 1
+    # Multiply-shift hash functions:
+    mult = rng.integers(0, 2**63, Nhash, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    add = rng.integers(0, 2**63, Nhash, dtype=np.uint64)
+    # Per sequence of a block: the shingles and one hashed copy (64 bits), and the residues:
+    nb = blockSize(Nseq, 17 * Nkmer, max_mem // max(1, workers))
+    blocks = rowBlocks(Nseq, nb, workers)
+    data = {'bitalg': bitalg, 'kmer': kmer, 'mult': mult, 'add': add}
+    return np.concatenate(poolMap(minHashBlock, blocks, workers, data) + [np.zeros((0, Nhash), dtype=np.uint32)])
+
+
+def minHashBlock(data, block):
+    ''' MinHash signatures of a block of sequences, called by minHash_.
+
+    .. _minHash: scaTools.html#scaTools.minHash '''
+    msa_num = data['bitalg'][block].num()
+    kmer, mult, add = data['kmer'], data['mult'], data['add']
+    Nkmer = msa_num.shape[1] - kmer + 1
+    # Shingles: (position, k-mer) packed in 64 bits, 5 bits per residue
+    shingles = np.arange(Nkmer, dtype=np.uint64)[None, :] << np.uint64(5 * kmer)
+    for k in range(kmer):
+        shingles = shingles | (msa_num[:, k:k + Nkmer].astype(np.uint64) << np.uint64(5 * k))
+    sig = np.zeros((msa_num.shape[0], len(mult)), dtype=np.uint32)
+    for h in range(len(mult)):
+        sig[:, h] = ((shingles * mult[h] + add[h]) >> np.uint64(32)).min(axis=1)
+    return sig
+
+
+def lshKeys(sig, Nbands, bandsize, rng):
+    ''' One 64-bit key per sequence and band of bandsize MinHash values (M x Nbands): two
+    sequences are candidates in a band if their keys are equal. Called by seqWeightsLSH_.
+
+    :Example:
+      >>> keys = lshKeys(sig, 48, 3, np.random.default_rng(0)) '''
+    keys = np.zeros((sig.shape[0], Nbands), dtype=np.uint64)
+    for band in range(Nbands):
+        values = sig[:, band * bandsize:(band + 1) * bandsize].astype(np.uint64)
+        mult = rng.integers(0, 2**63, bandsize, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        keys[:, band] = (values * mult).sum(axis=1)
+    return keys
+
+
+def lshGroups(keys, max_bucket=1000, seed=0):
+    ''' The groups of candidates of each band (M x Nbands labels, equal for the sequences of a
+    group): the buckets of equal keys, with the buckets larger than max_bucket split at random
+    (with a generator seeded by seed and the band) into groups of at most max_bucket sequences.
+    Called by seqWeightsLSH_.
+
+    .. _seqWeightsLSH: scaTools.html#scaTools.seqWeightsLSH
+
+    :Example:
+      >>> groups = lshGroups(keys, max_bucket=1000, seed=0) '''
+    Nseq, Nbands = keys.shape
+    groups = np.zeros((Nseq, Nbands), dtype=np.int64)
+    for band in range(Nbands):
+        rng = np.random.default_rng([seed, band])
+        order = np.argsort(keys[:, band], kind='stable')
+        bandkeys = keys[order, band]
+        starts = np.flatnonzero(np.r_[True, bandkeys[1:] != bandkeys[:-1]])
+        sizes = np.diff(np.r_[starts, Nseq])
+        labels = np.repeat(starts, sizes)
+        # Large buckets shuffled and cut in equal parts, labelled by their first rank:
+        for start, size in zip(starts[sizes > max_bucket], sizes[sizes > max_bucket]):
+            order[start:start + size] = rng.permutation(order[start:start + size])
+            Ncut = -(-size // max_bucket)
+            cuts = start + (size * np.arange(Ncut + 1)) // Ncut
+            labels[start:start + size] = np.repeat(cuts[:-1], np.diff(cuts))
+        groups[order, band] = labels
+    return groups
+
+
+def lshBand(data, band):
+    ''' Number of neighbors (weighted by data['mult']) of each sequence among its candidates of
+    a band: the pairs in the same group of data['groups'][:, band] (lshGroups_), but not in the
+    same group of an earlier band, where they have already been verified. The pairs are verified
+    exactly by chunks that fit in data['max_mem']. Called by seqWeightsLSH_.
+
+    .. _lshGroups: scaTools.html#scaTools.lshGroups
+    .. _seqWeightsLSH: scaTools.html#scaTools.seqWeightsLSH '''
+    bitalg, groups, mult = data['bitalg'], data['groups'], data['mult']
+    Nseq, Npos = bitalg.shape
+    order = np.argsort(groups[:, band], kind='stable')
+    labels = groups[order, band]
+    first = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])
+    gsizes = np.diff(np.r_[first, Nseq])
+    # Per pair of a chunk: indices, identities and labels compared (64 bits), and flags:
+    npairs = blockSize(Nseq * max(1, gsizes.max(initial=1)), 64, data['max_mem'])
+    counts = np.zeros(Nseq, dtype=np.int64)
+    for size in np.unique(gsizes[gsizes > 1]):
+        starts = first[gsizes == size]
+        i1, i2 = np.triu_indices(size, 1)
+        ng = max(1, npairs // len(i1))
+        for g in range(0, len(starts), ng):
+            s1 = order[starts[g:g + ng, None] + i1].ravel()
+            s2 = order[starts[g:g + ng, None] + i2].ravel()
+            # Pairs already verified in an earlier band:
+            earlier = np.zeros(len(s1), dtype=bool)
+            for b in range(band):
+                earlier |= groups[s1, b] == groups[s2, b]
+            s1, s2 = s1[~earlier], s2[~earlier]
+            close = bitalg.pairIdentity(s1, s2, data['gaps']) / Npos > data['max_seqid']
+            s1, s2 = s1[close], s2[close]
+            counts += np.bincount(s1, mult[s2], minlength=Nseq).astype(np.int64)
+            counts += np.bincount(s2, mult[s1], minlength=Nseq).astype(np.int64)
+    return counts
+
+
+def filterSeq(alg0, sref=0.5, max_fracgaps=.2, min_seqid=.2, max_seqid=.8, workers=1, method='exact'):
     ''' Take in an alignment (alg0, assumed to be filtered to remove highly gapped positions),
     a reference sequence, the maximum fraction of gaps allowed per sequence (max_fracgaps),
     the minimum and maximum sequence identities to the reference sequence (min_seqid 
@@ -452,24 +1198,47 @@ def filterSeq(alg0, sref=0.5, max_fracgaps=.2, min_seqid=.2, max_seqid=.8):
 
     .. _chooseRefSeq: scaTools.html#scaTools.chooseRefSeq
 
+    The alignment can be a list of sequences, be in numeric representation (lett2num_) or be a
+    BitAlg_, and alg is returned in the same form. The sequence weights are computed on the
+    distinct sequences (uniqueSeqs_), with the given number of worker processes and method
+    (see seqWeights_).
+
     **Example:**
         >>> alg, seqw, seqkeep = filterSeq(alg0, iref, max_fracgaps=.2, min_seqid=.2, max_seqid=.8) 
 
     '''
     if (sref == 0.5):
-        sref = chooseRefSeq(alg0)
-    Nseq, Npos = len(alg0), len(alg0[0])
+        sref = chooseRefSeq(alg0, workers=workers)
+    if isinstance(alg0, BitAlg):
+        Nseq, Npos = alg0.shape
+        numgaps = alg0.gapCount()
+        numid = alg0.identity([sref])[:, 0]
+    else:
+        if isinstance(alg0, np.ndarray):
+            msa0, gap = alg0, 0
+        else:
+            msa0, gap = lett2bytes(alg0), ord('-')
+        Nseq, Npos = msa0.shape
+        numgaps = (msa0 == gap).sum(axis=1)
+        numid = (msa0 == msa0[sref]).sum(axis=1)
     # Elimination of sequences with too many gaps:
-    seqkeep0 = [s for s in range(Nseq) if alg0[s].count('-') / Npos < max_fracgaps]
+    seqkeep0 = np.flatnonzero(numgaps / Npos < max_fracgaps)
     print ("Keeping %i sequences of %i sequences (after filtering for gaps)" % (len(seqkeep0), Nseq))
     # Elimination of sequences too dissimilar to the reference (trimming):
-    seqkeep = [s for s in seqkeep0 if sum([alg0[s][i] == alg0[sref][i] for i in range(Npos)]) / Npos > min_seqid]
+    seqkeep = seqkeep0[numid[seqkeep0] / Npos > min_seqid].tolist()
     print ("Keeping %i sequences of %i sequences (after filtering for seq similarity)" % (len(seqkeep), len(seqkeep0)))
-    alg = [alg0[s] for s in seqkeep]
+    if isinstance(alg0, (np.ndarray, BitAlg)):
+        alg = alg0[seqkeep]
+    else:
+        alg = [alg0[s] for s in seqkeep]
     # Sequence weights (smoothing, here effectively treats gaps as a 21st
-    # amino acid):
-    msa_num = lett2num(alg)
-    seqw = seqWeights(alg, max_seqid)
+    # amino acid), computed once for each distinct sequence:
+    index, inverse, mult = uniqueSeqs(alg)
+    if isinstance(alg, (np.ndarray, BitAlg)):
+        alg_u = alg[index]
+    else:
+        alg_u = [alg[s] for s in index]
+    seqw = seqWeights(alg_u, max_seqid, workers=workers, method=method, mult=mult)[:, inverse]
     return alg, seqw, seqkeep
 
 
@@ -477,7 +1246,7 @@ def filterPos(alg, seqw=[1], max_fracgaps=.2):
     ''' Truncate the positions of an input alignment to reduce gaps, taking into account sequence weights.
 
     **Arguments:**
-        -  `alg` = An MxL list of sequences 
+        -  `alg` = An MxL list of sequences, or alignment in numeric representation (lett2num_)
 
     **Keyword Arguments:**
         -  `seqw` = vector of sequence weights (default is uniform weights)
@@ -491,21 +1260,28 @@ def filterPos(alg, seqw=[1], max_fracgaps=.2):
        >>> alg_tr, selpos = filterPos(alg, seqw, max_fracgaps=.2) 
 
     '''
-    Nseq, Npos = len(alg), len(alg[0])
+    if isinstance(alg, np.ndarray):
+        msa, gap = alg, 0
+    else:
+        msa, gap = lett2bytes(alg), ord('-')
+    Nseq, Npos = msa.shape
     if len(seqw) == 1:
         seqw = np.tile(1, (1, Nseq))
     # Fraction of gaps, taking into account sequence weights:
-    gapsMat = np.array([[int(alg[s][i] == '-') for i in range(Npos)] for s in range(Nseq)])
+    gapsMat = (msa == gap).astype(int)
     seqwn = seqw / seqw.sum()
     gapsperpos = seqwn.dot(gapsMat)[0]
     # Selected positions:
-    selpos = [i for i in range(Npos) if gapsperpos[i] < max_fracgaps]
+    selpos = np.flatnonzero(gapsperpos < max_fracgaps).tolist()
     # Truncation:
-    alg_tr = [''.join([alg[s][i] for i in selpos]) for s in range(Nseq)]
+    if isinstance(alg, np.ndarray):
+        alg_tr = alg[:, selpos]
+    else:
+        alg_tr = [seq.tobytes().decode() for seq in msa[:, selpos]]
     return alg_tr, selpos
 
 
-def randSel(seqw, Mtot, keepSeq=[]):
+def randSel(seqw, Mtot, keepSeq=[], seed=0):
     ''' Random selection of Mtot sequences, drawn with weights and without replacement.
         The seed for the random number generator is fixed to ensure reproducibility.
 
@@ -516,17 +1292,21 @@ def randSel(seqw, Mtot, keepSeq=[]):
         **Keyword Arguments:**
             -  `keepSeq` = an (optional) list of sequnces to keep. This can be useful if you would like to 
                            retain the reference sequence for example.
+            -  `seed` = seed of the (local) random number generator
 
         :Example:
       >>> selection = randSel(seqw, Mtot, [iref]) 
     '''
-    rand.seed(0)
-    return weighted_rand_list(seqw[0], Mtot, keepSeq)
+    rng = np.random.default_rng(seed)
+    return weighted_rand_list(seqw[0], Mtot, keepSeq, rng)
 
 
-def weighted_rand_list(weights, Nmax, keepList):
+def weighted_rand_list(weights, Nmax, keepList, rng=None):
     ''' Generate a random list of at most Nmax elements with weights (numpy array) but 
-    without replacement. Called by randSel_.
+    without replacement. Called by randSel_. Each element is given the key -log(u)/w, with
+    u uniform in (0, 1] and w its weight, and the elements with the smallest keys are selected
+    (in order of increasing keys), which amounts to drawing them one at a time with probabilities
+    proportional to the weights of the remaining elements, in O(N log N).
 
     .. _randSel: scaTools.html#scaTools.randSel
 
@@ -534,41 +1314,34 @@ def weighted_rand_list(weights, Nmax, keepList):
       >>> selection = weighted_rand_list(weights, Nmax, [iref]) 
 
     '''
-    Ntot = min((weights > 0).sum(), Nmax)
-    wlist = [w for w in weights]
-    selection = list()
-    for k in keepList:
-        selection.append(k)
-        wlist[k] = 0
-        Ntot -= 1
-    for k in range(Ntot):
-        i = weighted_rand_sel(wlist)
-        selection.append(i)
-        wlist[i] = 0
-    return selection
-
-
-def weighted_rand_sel(weights):
+    if rng is None:
+        rng = np.random.default_rng()
+    weights = np.array(weights, dtype=float).ravel()
+    Ntot = min((weights > 0).sum(), Nmax) - len(keepList)
+    weights[list(keepList)] = 0
+    candidates = np.flatnonzero(weights > 0)
+    keys = -np.log(1 - rng.random(len(candidates))) / weights[candidates]
+    order = np.argsort(keys, kind='stable')[:max(0, Ntot)]
+    return list(keepList) + candidates[order].tolist()
+
+
+def weighted_rand_sel(weights, rng=None):
     ''' Generate a random index with probability given by input weights.
-    Called by weighted_rand_list_.
-
-    .. _weighted_rand_list: scaTools.html#scaTools.weighted_rand_list
 
     :Example:
       >>> index = weighted_rand_sel(weights) 
 
     '''
-    rnd = rand.random() * sum(weights)
-    for i, w in enumerate(weights):
-        rnd -= w
-        if rnd < 0:
-            return i
+    if rng is None:
+        rng = np.random.default_rng()
+    cumw = np.cumsum(weights)
+    return int(np.searchsorted(cumw, rng.random() * cumw[-1], side='right'))
 
 ##########################################################################
 # BASIC STATISTICAL FUNCTIONS
 
 
-def freq(alg, seqw=1, Naa=20, lbda=0, freq0=np.ones(20) / 21):
+def freq(alg, seqw=1, Naa=20, lbda=0, freq0=np.ones(20) / 21, mult=None, dtype=float):
     ''' 
     Compute amino acid frequencies for a given alignment.
 
@@ -582,12 +1355,19 @@ def freq(alg, seqw=1, Naa=20, lbda=0, freq0=np.ones(20) / 21):
         - `Naa` = the number of amino acids
         - `lbda` = lambda parameter for setting the frequency of pseudo-counts (0 for no pseudo counts)
         - `freq0` = expected average frequency of amino acids at all positions
+        - `mult` = multiplicities of the sequences, when alg holds the distinct sequences of an
+                   alignment (see uniqueSeqs_), with seqw the weight of each copy
+        - `dtype` = the data type of freq2 (np.float32 halves its memory, see PairFreq_)
 
     **Returns:**
         -  `freq1` = the frequencies of amino acids at each position taken independently (Naa*L)
         -  `freq2` = the joint frequencies of amino acids at pairs of positions (freq2, Naa*L * Naa*L) 
         -  `freq0` = the average frequency of amino acids at all positions (Naa)
 
+    For large alignments, PairFreq_ gives the joint frequencies by blocks, without the dense matrix.
+
+    .. _PairFreq: scaTools.html#scaTools.PairFreq
+
     :Example:
       >>> freq1, freq2, freq0 = freq(alg, seqw, lbda=lbda) 
 
@@ -595,33 +1375,72 @@ def freq(alg, seqw=1, Naa=20, lbda=0, freq0=np.ones(20) / 21):
     Nseq, Npos = alg.shape
     if type(seqw) == int and seqw == 1:
         seqw = np.ones((1, Nseq))
+    if mult is not None:
+        seqw = seqw * mult
+    freq1_reg, freq0_reg = singleFreq(alg, seqw, Naa, lbda, freq0)
+    # Joint frequencies, with the background added to the diagonal blocks:
+    freq2_reg = PairFreq(alg, seqw, Naa, lbda, freq0, dtype=dtype).full()
+    return freq1_reg, freq2_reg, freq0_reg
+
+
+def singleFreq(alg, seqw=1, Naa=20, lbda=0, freq0=np.ones(20) / 21, mult=None):
+    ''' 
+    Compute the single-site amino acid frequencies for a given alignment, as returned by freq_,
+    without the joint frequencies: the weights of the sequences are summed for each position
+    with np.bincount, in O(ML) time and O(M) additional memory.
+
+    .. _freq: scaTools.html#scaTools.freq
+
+    **Arguments:**
+        -  `alg` = a MxL sequence alignment (converted using lett2num_) 
+
+    **Keyword Arguments:**
+        - `seqw`, `Naa`, `lbda`, `freq0`, `mult` = as in freq_
+
+    **Returns:**
+        -  `freq1` = the frequencies of amino acids at each position taken independently (Naa*L)
+        -  `freq0` = the average frequency of amino acids at all positions (Naa)
+
+    :Example:
+      >>> freq1, freq0 = singleFreq(alg, seqw, lbda=lbda) 
+
+    '''
+    Nseq, Npos = alg.shape
+    if type(seqw) == int and seqw == 1:
+        seqw = np.ones((1, Nseq))
+    if mult is not None:
+        seqw = seqw * mult
     seqwn = seqw / seqw.sum()
-    al2d = alg2bin(alg, Naa)
-    freq1 = seqwn.dot(np.array(al2d.todense()))[0]
-    freq2 = np.array(al2d.T.dot(scipy.sparse.diags(seqwn[0], 0)).dot(al2d).todense())
-    # Background:
-    block = np.outer(freq0, freq0)
-    freq2_bkg = np.zeros((Npos * Naa, Npos * Naa))
+    freq1 = np.zeros(Npos * Naa)
     for i in range(Npos):
-        freq2_bkg[Naa * i:Naa * (i + 1), Naa * i:Naa * (i + 1)] = block
+        freq1[Naa * i:Naa * (i + 1)] = np.bincount(alg[:, i], seqwn[0], minlength=Naa + 1)[1:Naa + 1]
     # Regularizations:
     freq1_reg = (1 - lbda) * freq1 + lbda * np.tile(freq0, Npos)
-    freq2_reg = (1 - lbda) * freq2 + lbda * freq2_bkg
     freq0_reg = freq1_reg.reshape(Npos, Naa).mean(axis=0)
-    return freq1_reg, freq2_reg, freq0_reg
+    return freq1_reg, freq0_reg
 
 
-def eigenVect(M):
+def eigenVect(M, k=None):
     ''' Return the eigenvectors and eigenvalues, ordered by decreasing values of the 
     eigenvalues, for a real symmetric matrix M. The sign of the eigenvectors is fixed
     so that the mean of its components is non-negative.
 
+    With k, only the k leading eigenvectors and eigenvalues are computed, with the
+    Lanczos algorithm (scipy.sparse.linalg.eigsh, started from the uniform vector so
+    that the result is reproducible), which is much faster than the full decomposition
+    for large matrices and small k. M can then also be a sparse matrix or a
+    LinearOperator.
+
     :Example:
        >>> eigenVectors, eigenValues = eigenVect(M) 
+       >>> eigenVectors, eigenValues = eigenVect(M, k=6)
 
     '''
-    eigenValues, eigenVectors = np.linalg.eigh(M)
-    idx = (-eigenValues).argsort()
+    if k is None or k >= M.shape[0] - 1:
+        eigenValues, eigenVectors = np.linalg.eigh(M)
+    else:
+        eigenValues, eigenVectors = scipy.sparse.linalg.eigsh(M, k, which='LA', v0=np.ones(M.shape[0]))
+    idx = (-eigenValues).argsort()[:k]
     eigenValues = eigenValues[idx]
     eigenVectors = eigenVectors[:, idx]
     for k in range(eigenVectors.shape[1]):
@@ -630,66 +1449,199 @@ def eigenVect(M):
     return eigenVectors, eigenValues
 
 
-def svdss(X, k=6):
+def svdss(X, k=6, method='arpack', oversample=None, Npower=6, seed=0, dtype=np.float64):
     ''' Singular value decomposition for sparse matrices (top k components). The singular
      values are ordered by decreasing values,  the sign of the singular vectors is fixed,
-    and the convention is that X = u.dot(s).dot(v.T):
+    and the convention is that X = u.dot(s).dot(v.T). The decomposition is computed, and
+    returned, with the given dtype (np.float32 or np.float64).
+
+    With method='randomized', the decomposition is computed by the randomized algorithm of
+    Halko, Martinsson & Tropp: the row space of X is sampled by k + oversample random vectors
+    (default oversample=k; generator seeded by seed), refined by Npower power iterations of
+    X^T X (each re-orthonormalized), and the SVD is made in this subspace. The cost is a fixed
+    number (2 Npower + 3) of products of X with (k + oversample)-column matrices, linear in the
+    number of rows of X, and the small factorizations are made on the side of the columns (20L)
+    only. The leading singular vectors are the most accurate: increase Npower or oversample if
+    the last of the k are needed precisely.
 
     :Example:
       >>> u, s ,v = svdss(X, k=6)
+      >>> u, s ,v = svdss(X, k=30, method='randomized')
 
     '''
-    u, s, vt = scipy.sparse.linalg.svds(X.astype(np.float64), k)
+    X = X.astype(dtype)
+    if method == 'randomized':
+        rng = np.random.default_rng(seed)
+        Nv = min(k + (k if oversample is None else oversample), min(X.shape))
+        # Orthonormal basis Q of the leading right singular subspace (Naa L x Nv, the smaller
+        # dimension for an alignment), by power iterations of X^T X:
+        Q = np.linalg.qr(X.T.dot(X.dot(rng.standard_normal((X.shape[1], Nv)))))[0]
+        for _ in range(Npower):
+            Q = np.linalg.qr(X.T.dot(X.dot(Q)))[0]
+        # SVD of X Q (M x Nv), from the eigendecomposition of the small matrix (X Q)^T X Q:
+        Y = X.dot(Q)
+        ev, vb = np.linalg.eigh(Y.T.dot(Y))
+        idx = (-ev).argsort()[:k]
+        s = np.sqrt(ev[idx])
+        u = Y.dot(vb[:, idx]) / s
+    else:
+        u, s, vt = scipy.sparse.linalg.svds(X, k)
     idx = (-s).argsort()
-    s = s[idx].astype(np.float128)
-    u = u[:, idx].astype(np.float128)
+    s = s[idx]
+    u = u[:, idx]
     for j in range(u.shape[1]):
         sign = np.sign(np.mean(u[:, j]))
         u[:, j] = sign * u[:, j]
-    v = X.T.dot(u).dot(np.diag(1 / s))
+    v = X.T.dot(u) / s
     return u, s, v
 
 
-def basicICA(x, r, Niter):
+def basicICA(x, r, Niter, tol=0, window=100, batch=None, seed=0):
     ''' Basic ICA algorithm, based on work by Bell & Sejnowski (infomax). The input data should preferentially be sphered, i.e., x.T.dot(x) = 1 
 
     **Arguments:**
       -  `x` = LxM input matrix where L = # features and M = # samples
       -  `r` = learning rate / relaxation parameter (e.g. r=.0001)
-      -  `Niter` =  number of iterations (e.g. 1000)
+      -  `Niter` =  maximal number of iterations (e.g. 1000)
+      -  `tol` = tolerance for the convergence (0 to always make Niter iterations): the iterations
+                 stop when the estimated distance of w to the fixed point, relative to the norm of
+                 w, is below tol. Close to convergence, the changes decrease geometrically with a
+                 rate rho (estimated from the changes over the last `window` iterations), and the
+                 distance to the fixed point is about |change| rho / (1 - rho).
+      -  `batch` = minibatch mode, for very large M: at each iteration, the gradient is computed
+                   from batch samples drawn at random (with the generator seeded by seed) and scaled
+                   by M / batch, so that the cost of the Niter iterations does not depend on M; w is
+                   the average of the iterates over the second half of the iterations, which removes
+                   most of the sampling noise (tol is then not used). As the full iterations are only
+                   stable for r M below about 1, the step r M is capped at .1 (the fixed point does
+                   not depend on it), and FloatingPointError is raised if the iterations diverge.
 
     **Returns:**
       -  `w` = unmixing matrix
-      -  `change` = record of incremental changes during the iterations.
+      -  `change` = record of incremental changes during the iterations (squared norms), of length the number of iterations made.
 
     **Note:** r and Niter should be adjusted to achieve convergence, which should be assessed by visualizing 'change' with plot(range(iter) ,change)
 
     **Example:**
-      >>> [w, change] = basicICA(x, r, Niter)
+      >>> [w, change] = basicICA(x, r, Niter, tol=1e-8)
 
     '''
     [L, M] = x.shape
     w = np.eye(L)
-    change = list()
-    for _ in range(Niter):
-        w_old = np.copy(w)
+    change = np.zeros(Niter)
+    if batch is not None and batch < M:
+        # Minibatch iterations (the gradient from batch sampled sequences is scaled by M / batch),
+        # averaged over the second half of the iterations:
+        rng = np.random.default_rng(seed)
+        step = min(r * M, .1)
+        w_mean = np.zeros((L, L))
+        for n in range(Niter):
+            xb = x[:, rng.integers(0, M, batch)]
+            u = w.dot(xb)
+            delta = step * (np.eye(L) - np.tanh(u / 2).dot(u.T) / batch).dot(w)
+            w += delta
+            change[n] = (delta**2).sum()
+            if n >= Niter // 2:
+                w_mean += w
+        if Niter == 0:
+            return [w, change]
+        if not np.isfinite(w_mean).all():
+            raise FloatingPointError("basicICA: the minibatch iterations diverged (step {:.3g})".format(step))
+        return [w_mean / (Niter - Niter // 2), change]
+    n = -1
+    for n in range(Niter):
         u = w.dot(x)
-        w += r * \
-            (M * np.eye(L) + (1 - 2 * (1. / (1 + np.exp(-u)))).dot(u.T)).dot(w)
-        delta = (w - w_old).ravel()
-        change.append(delta.dot(delta.T))
-    return [w, change]
+        # (1 - 2 / (1 + exp(-u)) = -tanh(u / 2)):
+        delta = r * (M * np.eye(L) - np.tanh(u / 2).dot(u.T)).dot(w)
+        w += delta
+        change[n] = (delta**2).sum()
+        if tol > 0 and n >= window and 0 < change[n] < change[n - window]:
+            rho = (change[n] / change[n - window])**(1 / (2 * window))
+            if np.sqrt(change[n]) * rho / (1 - rho) < tol * np.linalg.norm(w):
+                break
+        elif tol > 0 and change[n] == 0:
+            break
+    return [w, change[:n + 1]]
+
+
+def fastICA(x, Niter=1000, tol=1e-10):
+    ''' Fixed-point ICA algorithm (FastICA, Hyvarinen & Oja, symmetric version with the nonlinearity
+    tanh, i.e. for super-gaussian components as basicICA_): the data is sphered, and the rows of the
+    orthogonal unmixing matrix are updated all at once and orthogonalized, until their directions
+    change by less than tol. The convergence is usually reached in a few tens of iterations.
+    The contrast is not that of basicICA_ (fixed variance of the components, and orthogonal
+    unmixing of the sphered data), so that the components can differ: on the alignments of Inputs/,
+    the independent components of the sequence projections (seqProj) are the same (overlaps above
+    0.97), but those of the positional eigenvectors can differ (overlaps down to 0.63), with
+    different sectors.
+
+    .. _basicICA: scaTools.html#scaTools.basicICA
+
+    **Arguments:**
+      -  `x` = LxM input matrix where L = # features and M = # samples
+      -  `Niter` = maximal number of iterations
+      -  `tol` = tolerance for the convergence (1 - the smallest overlap of a row of the unmixing
+                 matrix with its previous value)
 
+    **Returns:**
+      -  `w` = unmixing matrix (for the input data x)
+      -  `change` = record of the changes during the iterations
+
+    **Example:**
+      >>> [w, change] = fastICA(x, Niter=1000, tol=1e-10)
 
-def rotICA(V, kmax=6, learnrate=.0001, iterations=10000):
+    '''
+    [L, M] = x.shape
+    x = np.asarray(x, dtype=float)
+    # Sphering:
+    ev, U = np.linalg.eigh(x.dot(x.T) / M)
+    sphere = U.dot(np.diag(1 / np.sqrt(ev))).dot(U.T)
+    z = sphere.dot(x)
+    w = np.eye(L)
+    change = np.zeros(Niter)
+    for n in range(Niter):
+        gu = np.tanh(w.dot(z))
+        w_new = gu.dot(z.T) / M - (1 - gu**2).mean(axis=1)[:, np.newaxis] * w
+        # Symmetric orthogonalization, (w w^T)^(-1/2) w:
+        u, s, vt = np.linalg.svd(w_new)
+        w_new = u.dot(vt)
+        change[n] = 1 - abs(np.diag(w_new.dot(w.T))).min()
+        w = w_new
+        if change[n] < tol:
+            break
+    return [w.dot(sphere), change[:n + 1]]
+
+
+def rotICA(V, kmax=6, learnrate=.0001, iterations=10000, tol=1e-8, method='infomax', verbose=False, batch=None,
+           seed=0):
     ''' ICA rotation (using basicICA) with default parameters and normalization of 
-    outputs. 
+    outputs. The iterations stop at convergence (tol, see basicICA_, or fastICA_ with
+    method='fastica', a fixed-point algorithm that converges in much fewer iterations); with
+    verbose, the number of iterations made is printed. With batch, the infomax iterations are made
+    on minibatches of batch vectors (see basicICA_), and only the final projection and
+    normalization use all the vectors: for the sequences of very large alignments, the cost then
+    hardly depends on their number (on the alignments of Inputs/, with batch=256, the independent
+    components of the sequences have overlaps above 0.9999 with those of the full iterations).
+    With the full iterations, the steps are stable only if learnrate times the number of vectors
+    (len(V)) is below about 1, so that learnrate has to be lowered for more than about 10000
+    vectors; with batch, this product is capped at .1, so that the default learnrate can be kept.
+
+    .. _basicICA: scaTools.html#scaTools.basicICA
+    .. _fastICA: scaTools.html#scaTools.fastICA
 
     :Example:
        >>> Vica, W = rotICA(V, kmax=6, learnrate=.0001, iterations=10000) 
     '''
     V1 = V[:, :kmax].T
-    [W, changes_s] = basicICA(V1, learnrate, iterations)
+    if method == 'fastica':
+        [W, changes_s] = fastICA(V1, iterations, tol)
+    else:
+        [W, changes_s] = basicICA(V1, learnrate, iterations, tol, batch=batch, seed=seed)
+    if verbose and batch is not None and batch < V1.shape[1] and method != 'fastica':
+        print_("ICA ({}, kmax={:d}): {:d} iterations on minibatches of {:d}".format(method, kmax, len(changes_s), batch))
+    elif verbose:
+        print_("ICA ({}, kmax={:d}): {:d} iterations{}".format(
+            method, kmax, len(changes_s), "" if len(changes_s) < iterations else " (no convergence)"))
     Vica = (W.dot(V1)).T
     for n in range(kmax):
         imax = abs(Vica[:, n]).argmax()
@@ -697,30 +1649,69 @@ def rotICA(V, kmax=6, learnrate=.0001, iterations=10000):
             Vica[imax, n]) * Vica[:, n] / np.linalg.norm(Vica[:, n])
     return Vica, W
 
+
+def rotICAList(Vlist, kmax=6, workers=1, **kwargs):
+    ''' ICA rotations (rotICA_) of several independent sets of vectors, e.g. the eigenvectors and
+    the sequence projections of scaSectorID, made concurrently by worker processes (workers, None
+    for all cores). kmax can be a list (one value per set of vectors), and the other keyword
+    arguments are those of rotICA_.
+
+    .. _rotICA: scaTools.html#scaTools.rotICA
+
+    :Example:
+       >>> [(Vpica, Wpica), (Usica, Wsica)] = rotICAList([Vsca, Usca], kmax=kpos, workers=2) '''
+    if np.isscalar(kmax):
+        kmax = [kmax] * len(Vlist)
+    data = {'Vlist': Vlist, 'kmax': kmax, 'kwargs': kwargs}
+    return poolMap(rotICATask, list(range(len(Vlist))), workers, data)
+
+
+def rotICATask(data, n):
+    ''' The ICA rotation of data['Vlist'][n], called by rotICAList_, possibly in a worker process.
+
+    .. _rotICAList: scaTools.html#scaTools.rotICAList '''
+    return rotICA(data['Vlist'][n], kmax=data['kmax'][n], **data['kwargs'])
+
 ##########################################################################
 # SCA FUNCTIONS
 
 
-def seqSim(alg):
+def seqSim(alg, workers=1):
     ''' Take an MxL alignment (converted to numeric representation using lett2num_) 
-    and compute a MxM matrix of sequence similarities.
+    (or a BitAlg_) and compute a MxM matrix of sequence similarities (aligned gaps do not count
+    as identities). The matrix is computed by blocks of sequences, distributed over the given
+    number of worker processes (None for all cores). Identical sequences are collapsed
+    (uniqueSeqs_) before the computation.
 
     :Example:
-      >>> simMat = seqSim(alg)
+      >>> simMat = seqSim(alg, workers=1)
 
     '''
-    # Get the number of sequences and number of positions:
-    [Nseq, Npos] = alg.shape
-    # Convert into a M*(20L) (sparse) binary array:
-    X2d = alg2bin(alg)
-    # Make the product with sparse matrices and convert it back to a dense
-    # array:
-    simMat = (X2d.dot(X2d.T)).todense() / Npos
-    return simMat
-
-
-def posWeights(alg, seqw=1, lbda=0, freq0=np.array([.073, .025, .050, .061, .042, .072,
-                                                    .023, .053, .064, .089, .023, .043, .052, .040, .052, .073, .056, .063, .013, .033])):
+    # Bit-packed alignment:
+    if not isinstance(alg, BitAlg):
+        alg = BitAlg(alg)
+    Nseq = alg.shape[0]
+    # Similarities between distinct sequences only:
+    index, inverse, mult = uniqueSeqs(alg)
+    if len(index) < Nseq:
+        return seqSim(alg[index], workers)[inverse][:, inverse]
+    # Identities by blocks of columns:
+    blocks = rowBlocks(Nseq, blockSize(Nseq, 25 * Nseq), workers)
+    simMat = np.zeros((Nseq, Nseq))
+    for block, simBlock in zip(blocks, poolMap(seqSimBlock, blocks, workers, {'bitalg': alg})):
+        simMat[:, block] = simBlock
+    return np.asmatrix(simMat)
+
+
+def seqSimBlock(data, block):
+    ''' Similarities between all sequences and a block of sequences. Called by seqSim_.
+
+    .. _seqSim: scaTools.html#scaTools.seqSim '''
+    bitalg = data['bitalg']
+    return bitalg.identity(block, gaps=False) / bitalg.shape[1]
+
+
+def posWeights(alg, seqw=1, lbda=0, freq0=aaFreq0, mult=None):
     ''' Compute single-site measures of conservation, and the sca position weights, :math:`\\frac {\partial {D_i^a}}{\partial {f_i^a}}`
 
     **Arguments:**
@@ -728,6 +1719,11 @@ def posWeights(alg, seqw=1, lbda=0, freq0=np.array([.073, .025, .050, .061, .042
          -  `seqw` = a vector of M sequence weights (default is uniform weighting)
          -  `lbda` = pseudo-counting frequencies, default is no pseudocounts
          -  `freq0` =  background amino acid frequencies :math:`q_i^a`
+         -  `mult` = multiplicities of the sequences, if alg holds distinct sequences (see freq_)
+
+    The frequencies are computed by singleFreq_ (no joint frequencies).
+
+    .. _singleFreq: scaTools.html#scaTools.singleFreq
 
     **Returns:**
          -  `Wia` = positional weights from the derivation of a relative entropy, :math:`\\frac {\partial {D_i^a}}{\partial {f_i^a}}` (Lx20)
@@ -742,7 +1738,7 @@ def posWeights(alg, seqw=1, lbda=0, freq0=np.array([.073, .025, .050, .061, .042
     N_aa = 20
     if type(seqw) == int and seqw == 1:
         seqw = np.ones((1, N_seq))
-    freq1, freq2, freq0 = freq(alg, Naa=20, seqw=seqw, lbda=lbda, freq0=freq0)
+    freq1, freq0 = singleFreq(alg, Naa=20, seqw=seqw, lbda=lbda, freq0=freq0, mult=mult)
     # Overall fraction of gaps:
     theta = 1 - freq1.sum() / N_pos
     # Background frequencies with gaps:
@@ -769,7 +1765,7 @@ def posWeights(alg, seqw=1, lbda=0, freq0=np.array([.073, .025, .050, .061, .042
     return Wia, Dia, Di
 
 
-def seqProj(msa_num, seqw, kseq=15, kica=6):
+def seqProj(msa_num, seqw, kseq=15, kica=6, workers=1, batch=None, svd='arpack', dtype=float):
     ''' Compute three different projections of the sequences based on eigenvectors of the sequence similarity matrix.
 
     **Arguments:**
@@ -779,6 +1775,20 @@ def seqProj(msa_num, seqw, kseq=15, kica=6):
     **Keyword Arguments:**
        -  `kseq` = number of eigenvectors to compute
        -  `kica` = number of independent components to compute
+       -  `workers` = number of worker processes for the three ICA rotations (see rotICAList_)
+       -  `batch` = minibatch size for the ICA rotations, for very large alignments (see rotICA_)
+       -  `svd` = 'arpack', or 'randomized' for the randomized algorithm, much faster for large
+                  alignments (see svdss_)
+       -  `dtype` = working precision of the sparse alignments, of their decompositions and of the
+                    sequence projections (np.float32 halves the memory)
+
+    The weights are applied by scaling the rows and columns of the sparse binary alignment
+    (scaleSparse_).
+
+    .. _rotICAList: scaTools.html#scaTools.rotICAList
+    .. _rotICA: scaTools.html#scaTools.rotICA
+    .. _svdss: scaTools.html#scaTools.svdss
+    .. _scaleSparse: scaTools.html#scaTools.scaleSparse
 
     **Returns:**
        -  `Useq[0]/Uica[0]` =  use no weight
@@ -792,29 +1802,28 @@ def seqProj(msa_num, seqw, kseq=15, kica=6):
     posw, Dia, Di = posWeights(msa_num, seqw)
     Useq = list()
     # 1 - raw:
-    X2d = alg2bin(msa_num)
-    Useq.append(svdss(X2d, k=kseq)[0])
+    X2d = alg2bin(msa_num, dtype=dtype)
+    Useq.append(svdss(X2d, k=kseq, method=svd, dtype=dtype)[0])
     # 2 - with sequence weights:
-    X2dw = sparsify(np.diag(np.sqrt(seqw[0]))).dot(X2d)
-    u, s, v = svdss(X2dw, k=kseq)
-    Useq.append(X2d.dot(v).dot(np.diag(1 / s)))
+    X2dw = scaleSparse(X2d, rows=np.sqrt(seqw[0]), dtype=dtype)
+    u, s, v = svdss(X2dw, k=kseq, method=svd, dtype=dtype)
+    Useq.append(X2d.dot(v) / s)
     # 3 - with sequence and position weights:
-    X2dp = X2d.dot(sparsify(np.diag(posw)))
-    X2dpw = sparsify(np.diag(np.sqrt(seqw[0]))).dot(X2dp)
-    u, s, v = svdss(X2dpw, k=kseq)
-    Useq.append(X2dp.dot(v).dot(np.diag(1 / s)))
+    X2dp = scaleSparse(X2d, cols=posw, dtype=dtype)
+    X2dpw = scaleSparse(X2dp, rows=np.sqrt(seqw[0]), dtype=dtype)
+    u, s, v = svdss(X2dpw, k=kseq, method=svd, dtype=dtype)
+    Useq.append(X2dp.dot(v) / s)
     # Fixing the sign:
     for U in Useq:
         for j in range(U.shape[1]):
             U[:, j] = np.sign(np.mean(U[:, j])) * U[:, j]
     # Rotation by ICA (default is kica=6):
-    Uica = list()
-    for U in Useq:
-        Uica.append(rotICA(U, kmax=kica)[0])
+    Uica = [Vica for Vica, W in rotICAList(Useq, kmax=kica, workers=workers, batch=batch)]
     return Useq, Uica
 
 
-def scaMat(alg, seqw=1, norm='frob', lbda=0, freq0=np.ones(20) / 21,):
+def scaMat(alg, seqw=1, norm='frob', lbda=0, freq0=np.ones(20) / 21, projectors=False, max_mem=2**30,
+           memmap=None, workers=1, Abin=None, dtype=float):
     ''' Computes the SCA matrix.
 
      **Arguments:**
@@ -828,11 +1837,37 @@ def scaMat(alg, seqw=1, norm='frob', lbda=0, freq0=np.ones(20) / 21,):
                       norm.  The frobenius norm is the default.
         -  `lbda` =  lambda parameter for setting the frequency of pseudo-counts (0 for no pseudo counts) 
         -  `freq0` = background expectation for amino acid frequencies
+        -  `projectors` = if True, also return the LxLx20 tensor P of the top singular vectors of
+                          the 20x20 blocks (P[i,j] the left vector of block (i,j), P[j,i] the right one,
+                          with the sign of the mean of the left vector).
+        -  `max_mem` = memory budget in bytes for the computation of the positional correlations
+        -  `memmap` = file name (.npy) for the LxL positional correlation matrix, which is then
+                      returned as a memory-mapped array (np.lib.format.open_memmap), for very large L
+        -  `workers` = number of worker processes for the tiles (None for all cores); the memory
+                       budget is shared between the workers
+        -  `Abin` = the sparse binary form of alg (alg2bin_, e.g. from randAlg_), if already computed
+        -  `dtype` = working precision: with np.float32, the joint frequencies, the tiles of tildeC
+                     and the projected alignment tX are stored in single precision (half the memory,
+                     and faster products), and the sums of squares of the blocks are accumulated
+                     in double precision; Cp is always in double precision
+
+     The positional correlations are computed by tiles of positions (I, J), J >= I, each from a
+     product of the weighted sparse binary alignment (PairFreq_) restricted to the positions in I
+     and J, so that the (20L)x(20L) matrix tildeC is never stored: the tiles are sized so that the
+     working memory stays within max_mem. The tiles are distributed over the worker processes
+     (largest first), which receive the weighted alignment once (poolIter_). The Frobenius norms of the 20x20 blocks are computed
+     from their sums of squares; the singular value decompositions (spectral norm, projectors)
+     are made on stacks of blocks.
+
+     .. _PairFreq: scaTools.html#scaTools.PairFreq
+     .. _poolIter: scaTools.html#scaTools.poolIter
+     .. _randAlg: scaTools.html#scaTools.randAlg
 
      **Returns:**
         -  `Cp` = the LxL SCA positional correlation matrix
         -  `tX` = the projected MxL alignment
         -  `projMat` = the projector
+        -  `P` = the tensor of block singular vectors (if projectors is True)
 
      :Example:
       >>> Csca, tX, projMat = scaMat(alg, seqw, norm='frob', lbda=0.03)
@@ -842,36 +1877,84 @@ def scaMat(alg, seqw=1, norm='frob', lbda=0, freq0=np.ones(20) / 21,):
     N_aa = 20
     if type(seqw) == int and seqw == 1:
         seqw = np.ones((1, N_seq))
-    freq1, freq2, freq0 = freq(alg, Naa=N_aa, seqw=seqw, lbda=lbda, freq0=freq0)
+    freq1 = singleFreq(alg, Naa=N_aa, seqw=seqw, lbda=lbda, freq0=freq0)[0]
+    if Abin is None:
+        Abin = alg2bin(alg, N_aa, dtype=np.uint8)
+    freq2 = PairFreq(alg, Naa=N_aa, seqw=seqw, lbda=lbda, freq0=freq0, Abin=Abin, dtype=dtype)
     W_pos = posWeights(alg, seqw, lbda)[0]
-    tildeC = np.outer(W_pos, W_pos) * (freq2 - np.outer(freq1, freq1))
-    # Positional correlations:
-    Cspec = np.zeros((N_pos, N_pos))
-    Cfrob = np.zeros((N_pos, N_pos))
-    P = np.zeros((N_pos, N_pos, N_aa))
-    for i in range(N_pos):
-        for j in range(i, N_pos):
-            u, s, vt = np.linalg.svd(tildeC[N_aa * i:N_aa * (i + 1), N_aa * j:N_aa * (j + 1)])
-            Cspec[i, j] = s[0]
-            Cfrob[i, j] = np.sqrt(sum(s**2))
-            P[i, j, :] = np.sign(np.mean(u[:, 0])) * u[:, 0]
-            P[j, i, :] = np.sign(np.mean(u[:, 0])) * vt[0, :].T
-    Cspec += np.triu(Cspec, 1).T
-    Cfrob += np.triu(Cfrob, 1).T
-    # Projector:
-    al2d = np.array(alg2bin(alg).todense())
-    tX = np.zeros((N_seq, N_pos))
+    # Positional correlations, by tiles of positions (I, J) of the weighted correlation
+    # matrix tildeC (about six (20 nb)^2 arrays in memory per tile):
+    if memmap is None:
+        Csca = np.zeros((N_pos, N_pos))
+    else:
+        Csca = np.lib.format.open_memmap(memmap, mode='w+', dtype=float, shape=(N_pos, N_pos))
+    if projectors:
+        P = np.zeros((N_pos, N_pos, N_aa))
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    nb = int(max(1, min(N_pos, np.sqrt(max_mem / max(1, workers) / (6 * np.dtype(dtype).itemsize * N_aa**2)))))
+    if workers > 1:
+        # At least about four tiles per worker:
+        nb = max(1, min(nb, -(-N_pos // int(np.ceil(np.sqrt(8 * workers))))))
+    tiles = rowBlocks(N_pos, nb)
+    tasks = [(I, J) for t, I in enumerate(tiles) for J in tiles[t:]]
+    # Largest tiles first, for the load balance (the diagonal tiles have half the blocks):
+    tasks.sort(key=lambda IJ: -(IJ[0].stop - IJ[0].start) * (IJ[1].stop - IJ[1].start) / (1 + (IJ[0] == IJ[1])))
+    data = {'freq2': freq2, 'freq1': freq1.astype(dtype), 'W_pos': W_pos.astype(dtype), 'norm': norm,
+            'projectors': projectors}
+    for (I, J), (Ctile, Ptile) in poolIter(scaTile, tasks, workers, data):
+        Csca[I, J] = Ctile
+        Csca[J, I] = Ctile.T
+        if projectors:
+            ipos, jpos, left, right = Ptile
+            P[ipos, jpos, :] = left
+            P[jpos, ipos, :] = right
+    # Projector (normalized at each position by projAlg):
     Proj = W_pos * freq1
-    ProjMat = np.zeros((N_pos, N_aa))
-    for i in range(N_pos):
-        Projati = Proj[N_aa * i:N_aa * (i + 1)]
-        if sum(Projati**2) > 0:
-            Projati /= np.sqrt(sum(Projati**2))
-        ProjMat[i, :] = Projati
-        tX[:, i] = al2d[:, N_aa * i:N_aa * (i + 1)].dot(Projati.T)
-    if norm == 'frob':
-        Cspec = Cfrob
-    return Cspec, tX, Proj
+    tX = projAlg(alg, Proj, Abin, dtype)
+    if projectors:
+        return Csca, tX, Proj, P
+    return Csca, tX, Proj
+
+
+def scaTile(data, tile):
+    ''' Positional correlations for a tile (I, J) of positions (slices, J >= I), from the weighted
+    correlation matrix tildeC restricted to the tile: the norms of its 20x20 blocks for j >= i
+    (mirrored on diagonal tiles), and, if data['projectors'] is True, the top singular vectors
+    of these blocks (positions i, j and the left and right vectors, signed as in scaMat_; else
+    None). Called by scaMat_, possibly in a worker process.
+
+    :Example:
+      >>> Ctile, Ptile = scaTile(data, (I, J)) '''
+    N_aa = 20
+    I, J = tile
+    freq1, W_pos, norm = data['freq1'], data['W_pos'], data['norm']
+    rowsI = slice(N_aa * I.start, N_aa * I.stop)
+    colsJ = slice(N_aa * J.start, N_aa * J.stop)
+    tildeC = np.outer(W_pos[rowsI], W_pos[colsJ]) * (data['freq2'].tile(I, J) - np.outer(freq1[rowsI], freq1[colsJ]))
+    nI, nJ = I.stop - I.start, J.stop - J.start
+    Ptile = None
+    if norm == 'frob' and not data['projectors']:
+        Ctile = np.sqrt((tildeC**2).reshape(nI, N_aa, nJ, N_aa).sum(axis=(1, 3), dtype=np.float64))
+    else:
+        # Blocks (i, j) with j >= i, stacked:
+        blocks = tildeC.reshape(nI, N_aa, nJ, N_aa).transpose(0, 2, 1, 3)
+        ki, kj = np.nonzero(np.arange(J.start, J.stop)[None, :] >= np.arange(I.start, I.stop)[:, None])
+        if data['projectors']:
+            u, s, vt = np.linalg.svd(blocks[ki, kj])
+            sign = np.sign(u[:, :, 0].mean(axis=1))[:, None]
+            Ptile = (ki + I.start, kj + J.start, sign * u[:, :, 0], sign * vt[:, 0, :])
+        else:
+            s = np.linalg.svd(blocks[ki, kj], compute_uv=False)
+        Ctile = np.zeros((nI, nJ))
+        if norm == 'frob':
+            Ctile[ki, kj] = np.sqrt((s**2).sum(axis=1, dtype=np.float64))
+        else:
+            Ctile[ki, kj] = s[:, 0]
+    if I == J:
+        Ctile = np.triu(Ctile)
+        Ctile += np.triu(Ctile, 1).T
+    return Ctile, Ptile
 
 ##########################################################################
 # PROJECTIONS OF ANNOATED SEQUENCES
@@ -886,10 +1969,9 @@ def projUica(msa_ann, msa_num, seqw, kica=6):
 
     '''
     X2d = alg2bin(msa_num)
-    posw, Dia, Di = posWeights(msa_num, seqw)
-    X2dw = sparsify(np.diag(np.sqrt(seqw[0]))).dot(X2d)
+    X2dw = scaleSparse(X2d, rows=np.sqrt(seqw[0]))
     u, s, v = svdss(X2dw, k=kica)
-    P = v.dot(np.diag(1 / s))
+    P = v / s
     U = X2d.dot(P)
     for j in range(U.shape[1]):
         P[:, j] = np.sign(np.mean(U[:, j])) * P[:, j]
@@ -909,8 +1991,11 @@ def projUica(msa_ann, msa_num, seqw, kica=6):
     return Ui1, Ui0
 
 
-def projAlg(alg, Proj):
+def projAlg(alg, Proj, Abin=None, dtype=float):
     ''' Projection of an alignment (alg) based on a projector (Proj). The input alignment should already be converted to numeric representation using lett2num_.
+    The projector (of length 20L) is normalized in place at each position, and applied as a sparse
+    20L x L matrix to the sparse binary alignment (alg2bin_, computed unless given as Abin). The
+    projected alignment has the given dtype.
 
     :Example:
       >>> tX = projAlg(msa_num, Proj) 
@@ -918,15 +2003,16 @@ def projAlg(alg, Proj):
     '''
     N_seq, N_pos = alg.shape
     N_aa = 20
-    al2d = np.array(alg2bin(alg).todense())
-    tX = np.zeros((N_seq, N_pos))
-    ProjMat = np.zeros((N_pos, N_aa))
-    for i in range(N_pos):
-        Projati = Proj[N_aa * i:N_aa * (i + 1)]
-        if sum(Projati**2) > 0:
-            Projati /= np.sqrt(sum(Projati**2))
-        ProjMat[i, :] = Projati
-        tX[:, i] = al2d[:, N_aa * i:N_aa * (i + 1)].dot(Projati.T)
+    # Normalization at each position:
+    ProjMat = Proj.reshape(N_pos, N_aa)
+    norms = np.sqrt((ProjMat**2).sum(axis=1))
+    ProjMat[norms > 0] /= norms[norms > 0, np.newaxis]
+    # Block-diagonal projector:
+    projector = sparsify((ProjMat.ravel().astype(dtype), (np.arange(N_aa * N_pos), np.repeat(np.arange(N_pos), N_aa))),
+                         shape=(N_aa * N_pos, N_pos))
+    if Abin is None:
+        Abin = alg2bin(alg, N_aa, dtype=np.uint8)
+    tX = Abin.dot(projector).toarray()
     return tX
 
 
@@ -1031,7 +2117,12 @@ def numConnected(Vp, k, distmat, eps_list=np.arange(.5, 0, -.01), dcontact=5):
 
 
 def chooseKpos(Lsca, Lrand):
-    ''' Given the eigenvalues of the sca matrix (Lsca), and the eigenvalues for the set of randomized matrices (Lrand), return the number of significant eigenmodes.'''
+    ''' Given the eigenvalues of the sca matrix (Lsca), and the eigenvalues for the set of randomized matrices (Lrand), return the number of significant eigenmodes.
+    Lrand is from the randomization trials (randomize_) or from the analytic null model
+    (randomizeAnalytic_).
+
+    .. _randomize: scaTools.html#scaTools.randomize
+    .. _randomizeAnalytic: scaTools.html#scaTools.randomizeAnalytic'''
     return Lsca[Lsca > (Lrand[:, 1].mean() + (3 * Lrand[:, 1].std()))].shape[0]
 
 
@@ -1150,31 +2241,93 @@ class Pair(object):
         self.dist = d
 
 
-def directInfo(freq1, freq2, lbda=.5, freq0=np.ones(20) / 21, Naa=20):
+def directInfo(freq1, freq2, lbda=.5, freq0=np.ones(20) / 21, Naa=20, workers=1, epsilon=1e-4):
     ''' Calculate direct information as in the Direct Coupling Analysis (DCA) method proposed by 
-    M. Weigt et collaborators (Ref: Marcos et al, PNAS 2011, 108: E1293-E1301).
+    M. Weigt et collaborators (Ref: Marcos et al, PNAS 2011, 108: E1293-E1301). The joint
+    frequencies freq2 can be a dense matrix (freq_) or a PairFreq_. The pairs of positions are
+    processed in batches (dirInfoBlock_), which can be distributed over several worker processes.
+
+    .. _dirInfoBlock: scaTools.html#scaTools.dirInfoBlock
 
     :Example:
-      >>> DI = directInfo(freq1, freq2, lbda=.5, freq0=np.ones(20)/21, Naa=20)
+      >>> DI = directInfo(freq1, freq2, lbda=.5, freq0=np.ones(20)/21, Naa=20, workers=4)
     '''
     Npos = int(len(freq1) / Naa)
-    Cmat_dat = freq2 - np.outer(freq1, freq1)
-    # Background:
+    # Connected correlations, computed in place by slabs of rows:
+    if isinstance(freq2, PairFreq):
+        Cmat = freq2.full()
+    else:
+        Cmat = np.array(freq2, dtype=float)
+    for slab in rowBlocks(Npos, blockSize(Npos, 8 * Naa**2 * Npos, 2**28)):
+        rows = slice(Naa * slab.start, Naa * slab.stop)
+        Cmat[rows] -= np.outer(freq1[rows], freq1)
+    # Regularizations, with the background added to the diagonal blocks:
     block = np.diag(freq0) - np.outer(freq0, freq0)
-    Cmat_bkg = np.zeros((Npos * Naa, Npos * Naa))
+    Cmat *= 1 - lbda
     for i in range(Npos):
-        Cmat_bkg[Naa * i:Naa * (i + 1), Naa * i:Naa * (i + 1)] = block
-    # Regularizations:
-    Cmat = (1 - lbda) * Cmat_dat + lbda * Cmat_bkg
+        Cmat[Naa * i:Naa * (i + 1), Naa * i:Naa * (i + 1)] += lbda * block
     frq = (1 - lbda) * freq1 + lbda * np.tile(freq0, Npos)
     # DI at mean-field approx:
     Jmat = -np.linalg.inv(Cmat)
+    del Cmat
+    # Consecutive blocks of pairs (i < j), in row order:
+    posi, posj = np.triu_indices(Npos, 1)
+    data = {'Jmat': Jmat, 'frq': frq, 'posi': posi, 'posj': posj, 'Naa': Naa, 'epsilon': epsilon}
+    blocks = rowBlocks(len(posi), blockSize(len(posi), 48 * (Naa + 1)**2, 2**27), workers)
     DI = np.zeros((Npos, Npos))
-    for i in range(Npos):
-        for j in range(i + 1, Npos):
-            DI[i, j] = dirInfoFromJ(i, j, Jmat, frq, Naa)
-            DI[j, i] = DI[i, j]
-    return DI
+    DI[posi, posj] = np.concatenate(poolMap(dirInfoBlock, blocks, workers, data) + [np.zeros(0)])
+    return DI + DI.T
+
+
+def dirInfoBlock(data, pairs):
+    ''' Direct information of a block of pairs of positions (a slice of the lists data['posi'] and
+    data['posj']), from the couplings data['Jmat'] and frequencies data['frq'] (called by
+    directInfo_ through poolMap_). This is the computation of dirInfoFromJ_ for all the pairs at
+    once: the fixed-point iterations run on stacked (Npairs, Naa+1, Naa+1) arrays, and each pair
+    leaves the iterations when it has converged.
+
+    .. _directInfo: scaTools.html#scaTools.directInfo
+    .. _dirInfoFromJ: scaTools.html#scaTools.dirInfoFromJ
+    .. _poolMap: scaTools.html#scaTools.poolMap
+
+    :Example:
+      >>> DIblock = dirInfoBlock(data, slice(0, 1000))
+    '''
+    Naa, epsilon = data['Naa'], data['epsilon']
+    posi, posj = data['posi'][pairs], data['posj'][pairs]
+    Npos = len(data['frq']) // Naa
+    Npairs = len(posi)
+    J4 = data['Jmat'].reshape(Npos, Naa, Npos, Naa)
+    W = np.ones((Npairs, Naa + 1, Naa + 1))
+    W[:, :Naa, :Naa] = np.exp(J4[posi, :, posj, :])
+    frq = np.ones((Npos, Naa + 1))
+    frq[:, :Naa] = data['frq'].reshape(Npos, Naa)
+    frq[:, Naa] = 1 - frq[:, :Naa].sum(axis=1)
+    pi, pj = frq[posi], frq[posj]
+    mui = np.ones((Npairs, Naa + 1)) / (Naa + 1)
+    muj = np.ones((Npairs, Naa + 1)) / (Naa + 1)
+    # Fixed point, on the pairs that have not converged yet:
+    active = np.arange(Npairs)
+    Wa, pia, pja, muia, muja = W, pi, pj, mui, muj
+    while len(active) > 0:
+        scrai = np.matmul(Wa, muja[:, :, None])[:, :, 0]
+        scraj = np.matmul(muia[:, None, :], Wa)[:, 0, :]
+        newi = pia / scrai
+        newi /= newi.sum(axis=1)[:, None]
+        newj = pja / scraj
+        newj /= newj.sum(axis=1)[:, None]
+        diff = np.maximum(abs(newi - muia).max(axis=1), abs(newj - muja).max(axis=1))
+        muia, muja = newi, newj
+        done = diff <= epsilon
+        if done.any():
+            mui[active[done]], muj[active[done]] = muia[done], muja[done]
+            keep = ~done
+            active, Wa, pia, pja, muia, muja = active[keep], Wa[keep], pia[keep], pja[keep], muia[keep], muja[keep]
+    Pdir = W * mui[:, :, None] * muj[:, None, :]
+    Pdir /= Pdir.sum(axis=(1, 2))[:, None, None]
+    Pfac = pi[:, :, None] * pj[:, None, :]
+    tiny = 1e-100
+    return (Pdir * np.log((Pdir + tiny) / (Pfac + tiny))).sum(axis=(1, 2))
 
 
 def dirInfoFromJ(i, j, Jmat, frq, Naa=20, epsilon=1e-4):
@@ -1261,27 +2414,35 @@ class Secton(object):
 # RANDOMIZATION
 
 
-def randAlg(frq, Mseq):
+def randAlg(frq, Mseq, rng=None, onehot=False):
     ''' Generate a random alignment with Mseq sequences based on the
     frequencies frq[i,a] of amino acids with a = 0,1,...,Naa (0 for gaps).
+    The composition of each column is drawn from a multinomial distribution
+    and the column is randomly permuted; all the columns are drawn at once.
+    The random numbers come from rng (a numpy Generator), or from a freshly
+    seeded generator if rng is None.
+
+    **Keyword Arguments:**
+        -  `onehot` = if True, also return the sparse binary form of the random
+                      alignment (as alg2bin_ with uint8 data), which can be given to scaMat_
 
     :Example:
-       >>> msa_rand = randAlg(frq, Mseq) 
+       >>> msa_rand = randAlg(frq, Mseq, np.random.default_rng(0)) 
 
     '''
-    Npos = frq.shape[0]
-    msa_rand = np.zeros((Mseq, Npos), dtype=int)
-    for i in range(Npos):
-        Maa = np.random.multinomial(Mseq, frq[i, :])
-        col = np.array([], dtype=int)
-        for aa, M in enumerate(Maa):
-            col = np.append(col, np.tile(aa, M))
-        np.random.shuffle(col)
-        msa_rand[:, i] = col
+    if rng is None:
+        rng = np.random.default_rng()
+    Npos, Nstates = frq.shape
+    counts = rng.multinomial(Mseq, frq)
+    cols = np.repeat(np.tile(np.arange(Nstates), Npos), counts.ravel()).reshape(Npos, Mseq)
+    msa_rand = np.ascontiguousarray(rng.permuted(cols, axis=1).T)
+    if onehot:
+        return msa_rand, alg2bin(msa_rand, Nstates - 1, dtype=np.uint8)
     return msa_rand
 
 
-def randomize(msa_num, Ntrials, seqw=1, norm='frob', lbda=0, Naa=20, kmax=6):
+def randomize(msa_num, Ntrials, seqw=1, norm='frob', lbda=0, Naa=20, kmax=6, workers=1, seed=0, Lsca=None,
+              min_trials=20, conf=0.99, partial=False, dtype=float):
     ''' Randomize the alignment while preserving the frequencies of amino acids at each 
     position and compute the resulting spectrum of the SCA matrix.
 
@@ -1293,37 +2454,345 @@ def randomize(msa_num, Ntrials, seqw=1, norm='frob', lbda=0, Naa=20, kmax=6):
         -  `lbda` = lambda parameter for setting the frequency of pseudo-counts (0 for no pseudo counts)
         -  `Naa` = number of amino acids
         -  `kmax` = number of eigenvectors to keep for each randomized trial
+        -  `workers` = number of worker processes for the trials (None for all cores)
+        -  `seed` = root seed: each trial draws from its own generator, spawned from
+                    np.random.SeedSequence(seed), so that the results depend neither on the number
+                    of workers nor on the order in which the trials complete
+        -  `Lsca` = the eigenvalues of the SCA matrix of the alignment, for the adaptive mode: the
+                    trials then stop (after at least min_trials, and at most Ntrials) as soon as the
+                    confidence interval (level conf) of the significance threshold of chooseKpos_
+                    contains no eigenvalue, so that more trials cannot change kpos (see kposStats_).
+                    The decision is taken on the trials in their order, so that it is also
+                    reproducible.
+        -  `partial` = if True, only the kmax leading eigenvectors and eigenvalues of each
+                    randomized matrix are computed (eigenVect_ with k=kmax), which is much faster for
+                    large L: Lrand then holds the kmax leading eigenvalues (all that chooseKpos_
+                    uses is the second one, so kmax must be at least 2)
+        -  `dtype` = working precision of the SCA matrices of the trials (see scaMat_); the mean
+                    matrix Crand is accumulated in double precision
+
+    .. _chooseKpos: scaTools.html#scaTools.chooseKpos
+    .. _kposStats: scaTools.html#scaTools.kposStats
+    .. _eigenVect: scaTools.html#scaTools.eigenVect
+    .. _scaMat: scaTools.html#scaTools.scaMat
 
     **Returns:**
         -  `Vrand` =  eigenvectors for the :math:`\\tilde {C_{ij}^{ab}}` matrix of the randomized alignment (dimensions: Ntrials*Npos*kmax)
-        -  `Lrand` =  eigenvalues for the :math:`\\tilde {C_{ij}^{ab}}` matrix of the randomized alignment  (dimensions: Ntrials*Npos)
+        -  `Lrand` =  eigenvalues for the :math:`\\tilde {C_{ij}^{ab}}` matrix of the randomized alignment  (dimensions: Ntrials*Npos, or Ntrials*kmax if partial)
+        -  `Crand` = the mean SCA matrix of the randomized alignments
+        -  `stats` = in the adaptive mode only, the stopping statistics (kposStats_), with the number
+                     of trials run ('Ntrials'), and 'min_trials', 'max_trials' and 'converged'
 
     :Example:
        >>> Vrand, Lrand, Crand = randomize(msa_num, 10, seqw, Naa=20, kmax=6)
 
     '''
+    if partial and kmax < 2:
+        raise ValueError("kmax must be at least 2 with partial=True (chooseKpos uses the second eigenvalue)")
+    Nseq, Npos = msa_num.shape
+    fr01, Mseq = randFreq(msa_num, seqw, lbda, Naa)
+    Crnd = np.zeros((Npos, Npos))
+    # Multiple randomizations, with the correlation matrices summed in the order of the trials:
+    Vrand = np.zeros((Ntrials, Npos, kmax))
+    Lrand = np.zeros((Ntrials, kmax if partial else Npos))
+    seeds = np.random.SeedSequence(seed).spawn(Ntrials)
+    data = {'frq': fr01, 'Mseq': Mseq, 'norm': norm, 'lbda': lbda, 'kmax': kmax, 'partial': partial, 'dtype': dtype}
+    pending, tsum = dict(), 0
+    stats = {'stable': False}
+    start = time.time()
+    for k, ((t, _), (V, L, Csca)) in enumerate(poolIter(randomizeTrial, list(enumerate(seeds)), workers, data)):
+        Vrand[t, :, :] = V
+        Lrand[t, :] = L
+        pending[t] = Csca
+        while tsum in pending and not stats['stable']:
+            Crnd += pending.pop(tsum)
+            tsum += 1
+            if Lsca is not None and tsum >= max(2, min_trials):
+                stats = kposStats(Lsca, Lrand[:tsum], conf)
+        print_("Randomization trial {:d} complete ({:d} of {:d}), time: {:.1f} s".format(
+            t, k + 1, Ntrials, time.time() - start))
+        if stats['stable']:
+            print_("Stopping after {:d} trials: threshold {:.3f} in [{:.3f}, {:.3f}], kpos = {:d}".format(
+                tsum, stats['threshold'], stats['low'], stats['high'], stats['kpos']))
+            break
+    Crnd = Crnd / tsum
+    if Lsca is None:
+        return Vrand, Lrand, Crnd
+    stats = kposStats(Lsca, Lrand[:tsum], conf)
+    stats.update({'Ntrials': tsum, 'min_trials': min_trials, 'max_trials': Ntrials, 'converged': stats['stable']})
+    return Vrand[:tsum], Lrand[:tsum], Crnd, stats
+
+
+def randFreq(msa_num, seqw=1, lbda=0, Naa=20):
+    ''' The frequencies from which the random alignments of randomize_ and randomizeAnalytic_
+    are drawn: the weighted frequencies of gaps and amino acids at each position (clipped to
+    [0, 1] and normalized, as the frequency of gaps can be very slightly negative from rounding
+    errors), and the number of sequences of the random alignments, the effective number of
+    sequences of msa_num.
+
+    .. _randomize: scaTools.html#scaTools.randomize
+    .. _randomizeAnalytic: scaTools.html#scaTools.randomizeAnalytic
+
+    :Example:
+       >>> fr01, Mseq = randFreq(msa_num, seqw, lbda=0.03) '''
+    Nseq, Npos = msa_num.shape
     if type(seqw) == int and seqw == 1:
         seqw = np.ones((1, Nseq))
     Mseq = np.round(seqw.sum()).astype(int)
-    Nseq, Npos = msa_num.shape
-    Crnd = np.zeros((Npos, Npos))
-    # Weighted frequencies, including gaps:
-    f1, f2, f0 = freq(msa_num, Naa=20, seqw=seqw, lbda=lbda, freq0=np.ones(20) / 21)
+    f1, f0 = singleFreq(msa_num, Naa=Naa, seqw=seqw, lbda=lbda, freq0=np.ones(Naa) / (Naa + 1))
     fr1 = np.reshape(f1, (Npos, Naa))
     fr0 = (1 - fr1.sum(axis=1)).reshape(Npos, 1)
-    fr01 = np.concatenate((fr0, fr1), axis=1)
-    # Multiple randomizations:
-    Vrand = np.zeros((Ntrials, Npos, kmax))
-    Lrand = np.zeros((Ntrials, Npos))
-    for t in range(Ntrials):
-        msa_rand = randAlg(fr01, Mseq)
-        Csca = scaMat(msa_rand, norm=norm, lbda=lbda)[0]
-        Crnd += Csca
-        V, L = eigenVect(Csca)
-        Vrand[t, :, :] = V[:, :kmax]
-        Lrand[t, :] = L
-    Crnd = Crnd / Ntrials
-    return Vrand, Lrand, Crnd
+    fr01 = np.clip(np.concatenate((fr0, fr1), axis=1), 0, 1)
+    fr01 /= fr01.sum(axis=1)[:, np.newaxis]
+    return fr01, Mseq
+
+
+def randomizeTrial(data, task):
+    ''' One trial of randomize_: a random alignment drawn from the frequencies data['frq'] with
+    the generator seeded by the task (trial number, SeedSequence), and the eigenvectors (kmax),
+    eigenvalues (all, or the kmax leading ones if data['partial'] is True) and SCA matrix of this
+    alignment. Called by randomize_, possibly in a worker process.
+
+    .. _randomize: scaTools.html#scaTools.randomize
+
+    :Example:
+       >>> V, L, Csca = randomizeTrial(data, (t, seedseq)) '''
+    t, seedseq = task
+    msa_rand, Abin = randAlg(data['frq'], data['Mseq'], np.random.default_rng(seedseq), onehot=True)
+    Csca = scaMat(msa_rand, norm=data['norm'], lbda=data['lbda'], Abin=Abin, dtype=data['dtype'])[0]
+    V, L = eigenVect(Csca, data['kmax'] if data['partial'] else None)
+    return V[:, :data['kmax']], L, Csca
+
+
+def randomizeAnalytic(msa_num, Ntrials, seqw=1, norm='frob', lbda=0, Naa=20, kmax=6):
+    ''' Analytic null model for the spectrum of the SCA matrix, a fast alternative to randomize_:
+    the mean and standard deviation of the second eigenvalue of the randomized matrices, whose
+    mean + 3 std is the significance threshold of chooseKpos_, are computed from the moments of
+    the correlations of the random alignments, without drawing any random alignment or matrix.
+
+    In the random alignments of randomize_ (Mseq sequences with independent positions, drawn
+    from the frequencies of msa_num, see randFreq_), the mean and the variance of the squared
+    positional correlations C_ij^2 follow from the column frequencies (randomizeMoments_), and
+    C_ij is approximated by the square root of a Gamma variable with these moments (Patnaik
+    approximation), whose mean gives the expected null matrix A (Crand) and whose variance the
+    variances V_ij of its elements. The second eigenvalue of A is assumed to be isolated from the
+    others and from the bulk of the spectrum of the noise, so that it is obtained by perturbation
+    theory, with v_k and l_k the eigenvectors and eigenvalues of A:
+
+        - mean: l_2 plus the second-order shift sum_k E[(v_k^T H v_2)^2] / (l_2 - l_k), for the
+          noise H of independent elements of variances V_ij,
+        - variance: the first-order variance of v_2^T H v_2, plus that of v_2^T A v_2 from the
+          fluctuations of the column frequencies (multinomial counts, linearized). The
+          derivatives of the factors of the moments (nullFactors_) with respect to the
+          frequencies are forward finite differences (step 1e-7); the other derivatives are
+          analytic.
+
+    The cost is that of an LxL eigendecomposition and a few LxL products, whatever the number of
+    sequences. Near the threshold, the eigenvalues of the SCA matrix should be checked with
+    randomize_ (see kposStats_): kpos may then differ by one.
+
+    So that the results can be used as those of randomize_ (chooseKpos_, histograms of Lrand
+    normalized by Ntrials), they are returned as Ntrials pseudo-trials: each row of Lrand holds
+    the eigenvalues of A, except for the second one, set to Ntrials quantiles of the normal
+    distribution of the analytic mean and standard deviation (rescaled so that their mean and
+    standard deviation are exactly these, hence Ntrials >= 2).
+
+    .. _randomize: scaTools.html#scaTools.randomize
+    .. _randFreq: scaTools.html#scaTools.randFreq
+    .. _randomizeMoments: scaTools.html#scaTools.randomizeMoments
+    .. _nullFactors: scaTools.html#scaTools.nullFactors
+    .. _chooseKpos: scaTools.html#scaTools.chooseKpos
+    .. _kposStats: scaTools.html#scaTools.kposStats
+
+    **Arguments:**
+        -  `Ntrials` = number of pseudo-trials (at least 2)
+        -  other arguments as for randomize_ (only the Frobenius norm is supported)
+
+    **Returns:**
+        -  `Vrand` = the kmax leading eigenvectors of A, for each pseudo-trial (Ntrials*Npos*kmax)
+        -  `Lrand` = the eigenvalues of the pseudo-trials (Ntrials*Npos)
+        -  `Crand` = the expected SCA matrix of the randomized alignments (A)
+        -  `null_stats` = dictionary with the 'mean' and 'std' of the second eigenvalue of the
+                          randomized matrices, and the 'threshold' of chooseKpos_
+
+    :Example:
+       >>> Vrand, Lrand, Crand, null_stats = randomizeAnalytic(msa_num, 100, seqw, lbda=0.03)
+       >>> kpos = chooseKpos(Lsca, Lrand)
+
+    '''
+    if Ntrials < 2:
+        raise ValueError("The analytic null model needs at least 2 pseudo-trials")
+    if norm != 'frob':
+        raise ValueError("The analytic null model is only available for the Frobenius norm (norm='frob')")
+    Npos = msa_num.shape[1]
+    fr01, Mseq = randFreq(msa_num, seqw, lbda, Naa)
+    frq = fr01[:, 1:]
+    S, varS = randomizeMoments(frq, Mseq, lbda)
+    # Expected square roots of the Gamma distributions, their variances and their derivatives
+    # with respect to the moments:
+    noise = varS > 0
+    k, theta = S[noise]**2 / varS[noise], varS[noise] / S[noise]
+    Crnd, Vnoise = np.sqrt(S), np.zeros((Npos, Npos))
+    Crnd[noise] = np.sqrt(theta) * np.exp(gammaln(k + .5) - gammaln(k))
+    Vnoise[noise] = np.maximum(S[noise] - Crnd[noise]**2, 0)
+    dS, dV = np.zeros((Npos, Npos)), np.zeros((Npos, Npos))
+    dS[S > 0] = .5 / Crnd[S > 0]
+    psi = digamma(k + .5) - digamma(k)
+    dS[noise] = Crnd[noise] * (2 * k * psi - .5) / S[noise]
+    dV[noise] = Crnd[noise] * (.5 - k * psi) / varS[noise]
+    # Perturbation of the second eigenvalue of the expected matrix:
+    L, V = np.linalg.eigh(Crnd)
+    L, V = L[::-1], V[:, ::-1]
+    v = V[:, 1]
+    Vv = V * v[:, None]
+    cross = (V**2).T.dot(Vnoise.dot(v**2)) + (Vnoise.dot(Vv) * Vv).sum(axis=0)
+    others = np.arange(Npos) != 1
+    mean = L[1] + (cross[others] / (L[1] - L[others])).sum()
+    var_noise = 2 * (v**2).dot(Vnoise).dot(v**2)
+    # Fluctuations of the column frequencies: derivatives of v^T A v with respect to the factors
+    # of the moments at each position, then to the frequencies:
+    P = nullFactors(frq, Mseq, lbda)
+    sTerms, vTerms = nullTerms(Mseq, lbda)
+    offdiag = 1 - np.eye(Npos)
+    dPhi = np.zeros(P.shape)
+    for dM, terms in ((dS, sTerms), (dV, vTerms)):
+        for col, coef in terms:
+            dPhi[:, col] += 2 * coef * v * (dM * offdiag).dot(v * P[:, col])
+    dPhi[:, -1] = v**2 * dS.diagonal()
+    gw0 = np.tile(((1 - lbda) * frq + lbda * aaFreq0).mean(axis=0), (Npos, 1))
+    grad = np.zeros(frq.shape)
+    h = 1e-7
+    for a in range(frq.shape[1]):
+        fh = frq.copy()
+        fh[:, a] += h
+        grad[:, a] = ((nullFactors(fh, Mseq, lbda, gw0) - P) * dPhi).sum(axis=1) / h
+    var_counts = ((frq * grad**2).sum() - ((frq * grad).sum(axis=1)**2).sum()) / Mseq
+    std = np.sqrt(var_noise + var_counts)
+    null_stats = {'mean': float(mean), 'std': float(std), 'threshold': float(mean + 3 * std)}
+    z = scipy.stats.norm.ppf((np.arange(Ntrials) + .5) / Ntrials)
+    Lrand = np.tile(L, (Ntrials, 1))
+    Lrand[:, 1] = mean + std * (z - z.mean()) / z.std()
+    Vrand = np.tile(V[:, :kmax], (Ntrials, 1, 1))
+    return Vrand, Lrand, Crnd, null_stats
+
+
+def randomizeMoments(frq, Mseq, lbda=0):
+    ''' Mean and variance of the squared positional correlations C_ij^2 (Frobenius norms) of a random
+    alignment of Mseq sequences with independent positions, given its column frequencies frq
+    (L x Naa, without gaps), for randomizeAnalytic_. The position weights and the regularized
+    frequencies are those of scaMat_ for these frequencies; for i != j, the block (i, j) of tildeC
+    is W_i (c f_i f_j^T - g_i g_j^T) W_j + c W_i S_ij W_j, with c = 1 - lbda, g_i the regularized
+    frequencies of scaMat_, and S_ij the sample covariance of the positions, of zero mean and
+    covariance (diag(f_i) - f_i f_i^T) x (diag(f_j) - f_j f_j^T) / Mseq: the mean and variance of
+    the squared norm (Gaussian approximation of S_ij for the variance) are sums of products of
+    quantities per position (nullFactors_, combined as in nullTerms_). The diagonal is the
+    squared norm of the (deterministic) diagonal blocks, with zero variance.
+
+    .. _randomizeAnalytic: scaTools.html#scaTools.randomizeAnalytic
+    .. _scaMat: scaTools.html#scaTools.scaMat
+    .. _nullFactors: scaTools.html#scaTools.nullFactors
+    .. _nullTerms: scaTools.html#scaTools.nullTerms
+
+    :Example:
+       >>> S, varS = randomizeMoments(frq, Mseq, lbda=0.03) '''
+    P = nullFactors(frq, Mseq, lbda)
+    sTerms, vTerms = nullTerms(Mseq, lbda)
+    S = sum(coef * np.outer(P[:, col], P[:, col]) for col, coef in sTerms)
+    varS = sum(coef * np.outer(P[:, col], P[:, col]) for col, coef in vTerms)
+    np.fill_diagonal(S, P[:, -1])
+    np.fill_diagonal(varS, 0)
+    return S, varS
+
+
+def nullFactors(frq, Mseq, lbda=0, gw0=None):
+    ''' The quantities per position (L x 9) whose products give the moments of randomizeMoments_,
+    each a function of the frequencies of its position only: with the notations of
+    randomizeMoments_, the weighted deterministic parts a_i = W_i f_i and h_i = W_i g_i, and
+    cov_i = W_i (diag(f_i) - f_i f_i^T) W_i, the columns are a_i.a_i, a_i.h_i, h_i.h_i, tr(cov_i),
+    |cov_i|^2, a_i^T cov_i a_i, a_i^T cov_i h_i, h_i^T cov_i h_i, and the squared norm of the
+    diagonal block (i, i). gw0 is the background of the position weights, by default the mean
+    regularized frequencies of frq as in posWeights_ (it is fixed when frq is perturbed to
+    compute derivatives).
+
+    .. _randomizeMoments: scaTools.html#scaTools.randomizeMoments
+    .. _posWeights: scaTools.html#scaTools.posWeights
+
+    :Example:
+       >>> P = nullFactors(frq, Mseq, lbda=0.03) '''
+    Npos, Naa = frq.shape
+    c = 1 - lbda
+    f0 = np.ones(Naa) / (Naa + 1)
+    # Frequencies of scaMat (freq1) and of posWeights, with their pseudo-counts, and weights
+    # (relative to the mean frequencies, as in posWeights):
+    g = c * frq + lbda * f0
+    gw = c * frq + lbda * aaFreq0
+    if gw0 is None:
+        gw0 = np.tile(gw.mean(axis=0), (Npos, 1))
+    W = np.zeros((Npos, Naa))
+    iok = (gw > 0) & (gw < 1)
+    W[iok] = abs(np.log((gw[iok] * (1 - gw0[iok])) / ((1 - gw[iok]) * gw0[iok])))
+    # Weighted multinomial covariances of the positions:
+    cov = W[:, :, None] * (frq[:, :, None] * np.eye(Naa) - frq[:, :, None] * frq[:, None, :]) * W[:, None, :]
+    # Deterministic parts of the blocks, and diagonal blocks:
+    a, h = W * frq, W * g
+    Bii = c * frq[:, :, None] * np.eye(Naa) + lbda * np.outer(f0, f0) - g[:, :, None] * g[:, None, :]
+    Bii = W[:, :, None] * Bii * W[:, None, :]
+    return np.stack([(a * a).sum(axis=1), (a * h).sum(axis=1), (h * h).sum(axis=1),
+                     np.trace(cov, axis1=1, axis2=2), (cov**2).sum(axis=(1, 2)),
+                     np.einsum('ia,iab,ib->i', a, cov, a), np.einsum('ia,iab,ib->i', a, cov, h),
+                     np.einsum('ia,iab,ib->i', h, cov, h), (Bii**2).sum(axis=(1, 2))], axis=1)
+
+
+def nullTerms(Mseq, lbda=0):
+    ''' The terms (column of nullFactors_, coefficient) of the off-diagonal mean S_ij and variance
+    varS_ij of randomizeMoments_, each the sum of coefficient x P[i, column] x P[j, column]:
+    S_ij = c^2 |a_i|^2 |a_j|^2 - 2 c (a_i.h_i)(a_j.h_j) + |h_i|^2 |h_j|^2 + c^2 tr(cov_i) tr(cov_j) / Mseq
+    (the norms of the deterministic parts factorize as the blocks are sums of outer products), and
+    varS_ij = 2 c^4 |cov_i|^2 |cov_j|^2 / Mseq^2 + 4 c^2 d^T (cov_i x cov_j) d / Mseq, for the
+    deterministic part d of the block.
+
+    .. _nullFactors: scaTools.html#scaTools.nullFactors
+    .. _randomizeMoments: scaTools.html#scaTools.randomizeMoments
+
+    :Example:
+       >>> sTerms, vTerms = nullTerms(Mseq, lbda=0.03) '''
+    c = 1 - lbda
+    sTerms = [(0, c**2), (1, -2 * c), (2, 1), (3, c**2 / Mseq)]
+    vTerms = [(4, 2 * c**4 / Mseq**2), (5, 4 * c**4 / Mseq), (6, -8 * c**3 / Mseq), (7, 4 * c**2 / Mseq)]
+    return sTerms, vTerms
+
+
+def kposStats(Lsca, Lrand, conf=0.99):
+    ''' Confidence interval of the significance threshold of chooseKpos_, mean + 3 std of the second
+    eigenvalue of the randomized matrices, estimated from Ntrials trials: with s the standard
+    deviation, the standard errors of the mean and of the standard deviation are approximately
+    s / sqrt(Ntrials) and s / sqrt(2 Ntrials), so that the threshold has a standard error
+    s sqrt(1 + 9 / 2) / sqrt(Ntrials), and the interval is this standard error (with s the
+    standard deviation with Ntrials - 1 degrees of freedom) times the quantile of the Student
+    t-distribution with Ntrials - 1 degrees of freedom. The number of significant eigenmodes kpos is
+    stable if no eigenvalue of Lsca falls in the interval. Called by randomize_.
+
+    The interval is approximate for few trials, as the threshold itself (computed as in
+    chooseKpos_) is then biased low: for normally distributed eigenvalues, a 99% interval contains
+    the threshold for about 96% of the sets of 5 or 10 trials, 97% for 20 trials, and 99% from
+    about 100 trials.
+
+    .. _chooseKpos: scaTools.html#scaTools.chooseKpos
+
+    .. _randomize: scaTools.html#scaTools.randomize
+
+    **Returns:**
+        a dictionary with the 'threshold', the bounds 'low' and 'high' of the interval, 'conf',
+        'kpos' and 'stable'
+
+    :Example:
+       >>> stats = kposStats(Lsca, Lrand, conf=0.99) '''
+    lrand = Lrand[:, 1]
+    threshold = lrand.mean() + 3 * lrand.std()
+    halfwidth = t.ppf((1 + conf) / 2, len(lrand) - 1) * lrand.std(ddof=1) * np.sqrt(5.5 / len(lrand))
+    low, high = threshold - halfwidth, threshold + halfwidth
+    return {'threshold': float(threshold), 'low': float(low), 'high': float(high), 'conf': conf,
+            'kpos': int((Lsca > threshold).sum()), 'stable': not ((Lsca > low) & (Lsca <= high)).any()}
 
 ##########################################################################
 # DISPLAY
@@ -0,0 +1,25 @@
+"""
+Analytic null model (scaTools.randomizeAnalytic), returned as pseudo-trials of randomize.
+"""
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import scaTools as sca
+
+
+def test_pseudo_trials_as_randomize():
+    rng = np.random.default_rng(0)
+    Nseq, Npos, Ntrials = 500, 40, 30
+    msa = rng.integers(0, 21, (Nseq, Npos)).astype(np.uint8)
+    Vtr, Ltr, Ctr = sca.randomize(msa, 3, lbda=.03)
+    Vrand, Lrand, Crand, null_stats = sca.randomizeAnalytic(msa, Ntrials, lbda=.03)
+    assert Vrand.shape == (Ntrials,) + Vtr.shape[1:]
+    assert Lrand.shape == (Ntrials, Ltr.shape[1]) and Crand.shape == Ctr.shape
+    # The threshold of chooseKpos on the pseudo-trials is that of the analytic null model:
+    threshold = Lrand[:, 1].mean() + 3 * Lrand[:, 1].std()
+    assert np.isclose(threshold, null_stats['threshold'])
+    Lsca = np.sort(np.concatenate([[threshold + 1, threshold + .01], Lrand[0, 2:]]))[::-1]
+    assert sca.chooseKpos(Lsca, Lrand) == 2
@@ -0,0 +1,30 @@
+"""
+Minibatch ICA rotations (scaTools.rotICA with batch) on a large number of vectors.
+"""
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import scaTools as sca
+
+
+def mixedSources(M, k, seed=0):
+    ''' Orthonormal M x k vectors spanning k mixed super-gaussian sources. '''
+    rng = np.random.default_rng(seed)
+    S = rng.laplace(size=(M, k))**3
+    mixing = np.linalg.qr(rng.standard_normal((k, k)))[0]
+    return np.linalg.qr(S.dot(mixing))[0]
+
+
+def test_batch_large_M_default_learnrate():
+    M, k = 20000, 6
+    V = mixedSources(M, k)
+    # Full iterations, with a learnrate scaled to be stable for this M:
+    Vfull, Wfull = sca.rotICA(V, kmax=k, learnrate=.05 / M, iterations=100000, tol=1e-10)
+    # Minibatch iterations, with the default learnrate (learnrate * M = 2):
+    Vbatch, Wbatch = sca.rotICA(V, kmax=k, batch=256)
+    assert np.isfinite(Wbatch).all() and np.isfinite(Vbatch).all()
+    overlaps = abs(Vfull.T.dot(Vbatch)).max(axis=0)
+    assert overlaps.min() > .999
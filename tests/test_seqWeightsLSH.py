@@ -0,0 +1,35 @@
+"""
+Approximate sequence weights (scaTools.seqWeightsLSH) on an alignment with a large cluster of
+close sequences, whose buckets are split into groups.
+"""
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import scaTools as sca
+
+
+def clusteredAlignment(Nclu, Nrand, Npos, mutrate=.05, seed=0):
+    ''' Nclu mutants of a random sequence followed by Nrand random sequences (numeric codes). '''
+    rng = np.random.default_rng(seed)
+    clu = np.tile(rng.integers(1, 21, Npos), (Nclu, 1))
+    mutated = rng.random(clu.shape) < mutrate
+    clu[mutated] = rng.integers(1, 21, mutated.sum())
+    return np.concatenate([clu, rng.integers(0, 21, (Nrand, Npos))]).astype(np.uint8)
+
+
+def test_split_buckets_per_sequence_weights():
+    Nclu = 3000
+    msa = clusteredAlignment(Nclu, 3000, 100)
+    seqw_ex = sca.seqWeights(msa)[0]
+    for max_bucket, max_ratio in ((200, 2.5), (1000, 1.25)):
+        seqw, err = sca.seqWeightsLSH(msa, max_bucket=max_bucket)
+        ratio = seqw[0] / seqw_ex
+        # Neighbors can be missed but never added, and the isolated sequences are exact:
+        assert (ratio >= 1 - 1e-12).all()
+        assert np.allclose(ratio[Nclu:], 1)
+        # Each sequence of the cluster is verified against most of its neighbors:
+        assert ratio[:Nclu].max() < max_ratio
+        assert ratio[:Nclu].mean() < (max_ratio + 1) / 2